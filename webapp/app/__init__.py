@@ -1,4 +1,5 @@
 from flask import Flask
+import logging
 from flask_bootstrap import Bootstrap
 #from flask_sqlalchemy import SQLAlchemy
 
@@ -6,6 +7,9 @@ def create_app():
     app = Flask(__name__, static_url_path="/static")
     app.config.from_object('config')
     Bootstrap(app)
+    #key=value lines, the debug messages are not even formatted below LOG_LEVEL
+    logging.basicConfig(level = app.config.get('LOG_LEVEL', 'WARNING'),
+                        format = "time=%(asctime)s level=%(levelname)s logger=%(name)s %(message)s")
     return(app)
 
 app = create_app()
@@ -1,53 +1,227 @@
 from flask import render_template,flash, redirect, request
 from app import app
 from datetime import datetime, timedelta
+import hashlib
 import json
-from .downloadJsonData import getData, getCoordinates, getElevation
-from .plotMeteogram import plotMeteogram, getTimeFrame, prop
-from timezonefinder import TimezoneFinder
-from matplotlib.pyplot import close as pltclose
+import gzip
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from . import downloadJsonData
+from .downloadJsonData import geocode, getElevation, getGridCell, getModelRun, getModelRunExpiry, getTimezone
+from .downloadJsonData import fetchEnsemble, getMeteogramData, getForecastDays, trimEnsemble, SingleFlight
+from .renderCache import RenderCache
+from .renderPool import RenderPool
+from .plotMeteogram import getMeteogramSeries
+from . import plotMeteogram
+from . import metrics
 import numpy as np
 
-tf = TimezoneFinder()
+log = logging.getLogger(__name__)
 
-def plotMeteogramFile(latitude = None, longitude = None, altitude = None, location = None, days = 3, plotType = "enhanced-hres"):
-    print(latitude, longitude)
-    print(plotType)
+downloadJsonData.configure(app.config)
+renderCache = RenderCache(app.config.get('RENDER_CACHE_SIZE', 256))
+renderPool = RenderPool(app.config.get('RENDER_WORKERS', 2),
+                        app.config.get('RENDER_TIMEOUT', 60),
+                        app.config.get('RENDER_JOBS_PER_WORKER', 200))
+
+#the independent i/o of a request (elevation, ensemble download, timezone) runs
+#concurrently in these threads, each stage has its own timeout
+pipeline = ThreadPoolExecutor(max_workers = app.config.get('PIPELINE_WORKERS', 16),
+                              thread_name_prefix = "pipeline")
+stageTimeouts = {"geocode": app.config.get('GEOCODE_STAGE_TIMEOUT', 10),
+                 "elevation": app.config.get('ELEVATION_STAGE_TIMEOUT', 2),
+                 "download": app.config.get('DOWNLOAD_STAGE_TIMEOUT', 30),
+                 "timezone": app.config.get('TIMEZONE_STAGE_TIMEOUT', 5)}
+_downloads = {}#(grid cell, forecast days) -> future of the ensemble download, while it runs
+_downloadsLock = threading.Lock()
+#renders in flight per render cache key and model run, identical requests wait for them
+renders = SingleFlight("render")
+
+def preload():
+    #loads everything the requests need up front instead of on first use, for a parent
+    #process that forks the web server workers (run.py --prefork). Starts no threads.
+    downloadJsonData.preload()
+    if renderPool.workers == 0:
+        plotMeteogram.preload()
+
+def runStage(future, stage, fallback = None, required = False):
+    #result of a pipeline stage, fallback if it is too slow or fails, unless the
+    #meteogram can not be made without it
+    try:
+        return future.result(timeout = stageTimeouts[stage])
+    except TimeoutError:
+        metrics.STAGE_TIMEOUTS.inc(stage)
+        if required:
+            raise
+        log.warning("stage=%s timeout=%ss fallback=%s", stage, stageTimeouts[stage], fallback)
+    except Exception as e:
+        if required:
+            raise
+        log.warning("stage=%s error=%r fallback=%s", stage, e, fallback)
+    return fallback
+
+def startDownload(latitude, longitude, days = None):
+    #future of the ensemble of the grid cell with enough forecast days for a meteogram of
+    #days days, a running download of the cell that is at least as long is shared
+    cell = getGridCell(latitude, longitude)
+    forecastDays = getForecastDays(days)
+    with _downloadsLock:
+        for (downloadCell, downloadDays), future in _downloads.items():
+            if downloadCell == cell and downloadDays >= forecastDays:
+                return future
+        key = (cell, forecastDays)
+        future = pipeline.submit(fetchEnsemble, longitude, latitude, forecastDays)
+        _downloads[key] = future
+    #outside of the lock, a finished future calls finishDownload right away
+    future.add_done_callback(lambda future: finishDownload(key, future))
+    return future
+
+def finishDownload(key, future):
+    with _downloadsLock:
+        if _downloads.get(key) is future:
+            del _downloads[key]
+
+def resolveCoordinates(latitude = None, longitude = None, location = None, onCoordinates = None):
+    #latitude, longitude and altitude of a request, from the place cache or geocoded and
+    #looked up. Starts no download, onCoordinates(latitude, longitude) is called as soon
+    #as the coordinates of a place that is not cached are known
     if location:
-        latitude, longitude, altitude, _ = getCoordinates([("--location", location)])
+        query = ("location", location)
     elif latitude is not None and longitude is not None:
-        latitude = float(latitude)
-        longitude = float(longitude)
-        altitude = getElevation(latitude, longitude)
-        if altitude is None:
-            altitude = -999
+        query = ("latlon", float(latitude), float(longitude))
     else:
-        latitude = 52.2646577
-        longitude = 10.5236066
-        altitude = 79
+        return 52.2646577, 10.5236066, 79
+    place = renderCache.getPlace(query)
+    if place is not None:
+        return place
+    if location:
+        latitude, longitude = runStage(pipeline.submit(geocode, location), "geocode", required = True)
+    latitude = float(latitude)
+    longitude = float(longitude)
+    if onCoordinates is not None:
+        onCoordinates(latitude, longitude)
+    elevation = pipeline.submit(getElevation, latitude, longitude)
+    #remembered when the elevation arrives, even if this request did not wait for it
+    elevation.add_done_callback(lambda elevation: rememberPlace(query, latitude, longitude, elevation))
+    altitude = runStage(elevation, "elevation")
+    if altitude is None:
+        altitude = -999
+    return latitude, longitude, altitude
+
+def resolvePlace(latitude = None, longitude = None, location = None, days = None):
+    #resolveCoordinates for a request that renders: the download and the timezone do not
+    #depend on the altitude, they are started right away and picked up by getMeteogramInput
+    def prefetch(latitude, longitude):
+        startDownload(latitude, longitude, days)
+        pipeline.submit(getTimezone, latitude, longitude)
+    return resolveCoordinates(latitude, longitude, location, prefetch)
+
+def rememberPlace(query, latitude, longitude, elevation):
+    if elevation.exception() is not None:
+        return
+    altitude = elevation.result()
+    if altitude is None:
+        altitude = -999
+    renderCache.putPlace(query, (latitude, longitude, altitude))
+
+def getTitle(location, latitude, longitude, altitude):
+    return location + " " + str(np.round(latitude, decimals = 2)) +\
+           "°/" + str(np.round(longitude, decimals = 2)) +\
+           "°/" + str(altitude) + "m"
+
+def getMeteogramKey(place, location, days, plotType):
+    #everything the rendered image of a resolved place depends on, besides the model run
+    latitude, longitude, altitude = place
+    title = getTitle(location, latitude, longitude, altitude)
+    return (getGridCell(latitude, longitude), days, plotType, title), (latitude, longitude, altitude, title)
+
+def resolveRequest(latitude = None, longitude = None, location = None, days = 3):
+    #the model run and the place a meteogram request is answered for, resolved once per request
+    #and used for both its etag and its body. The download and the timezone of a new place
+    #start while its elevation is looked up, for a 304 they only fill the caches.
+    return getModelRun(), resolvePlace(latitude, longitude, location, days)
+
+def getMeteogramEtag(resolved, location = None, days = 3, plotType = "enhanced-hres", variant = "png"):
+    #etag of the image (or its json data) of a resolved request and the number of seconds it stays valid
+    modelRun, place = resolved
+    key, _ = getMeteogramKey(place, location, days, plotType)
+    etag = hashlib.sha1(repr((key, modelRun, variant)).encode("utf-8")).hexdigest()
+    maxAge = int((getModelRunExpiry(modelRun) - datetime.utcnow()).total_seconds())
+    return etag, max(maxAge, 0)
+
+def getMeteogramInput(latitude, longitude, altitude, days):
+    #meteogram data and timezone of a place, without a timezone the meteogram is in UTC
+    download = startDownload(latitude, longitude, days)
+    timezone = pipeline.submit(getTimezone, latitude, longitude)
+    #a longer download may have answered, the meteogram only sees the days it needs
+    ensemble = trimEnsemble(runStage(download, "download", required = True), getForecastDays(days))
+    tzName = runStage(timezone, "timezone")
     if days <= 10:
-        allMeteogramData = getData(float(longitude), float(latitude), altitude, writeToFile = False)
+        allMeteogramData = getMeteogramData(ensemble)
     else:
-        allMeteogramData = getData(float(longitude), float(latitude), altitude, writeToFile = False, meteogram = "15days")
-    tzName = tf.timezone_at(lat=latitude, lng=longitude)
-    today = datetime.utcnow()
-    fromIndex, toIndex = getTimeFrame(allMeteogramData, today, today + timedelta(days))
-    fromIndex = 0
-    fig = plotMeteogram(allMeteogramData, fromIndex, toIndex, tzName, plotType)
-    filename = str(today) + str(latitude) + str(longitude) + "forecast.png"
-    tmpSize = prop.get_size()
-    prop.set_size(16)
-    print(tmpSize)
-    fig.suptitle(location + " " + str(np.round(latitude, decimals = 2)) +\
-                  "°/" + str(np.round(longitude, decimals = 2)) +\
-                  "°/" + str(altitude) + "m", fontproperties=prop)
-    prop.set_size(tmpSize)
-    if '2t' in allMeteogramData:
-        #fig.text(0.1,0.03,allMeteogramData['2t']['date']+"-"+allMeteogramData['2t']['time'],fontproperties=prop)
-        fig.text(0.2,0.06,"Forecast from the European Weather Centre from " + allMeteogramData['2t']['date']+" at "+allMeteogramData['2t']['time'][0:2] + ":" + allMeteogramData['2t']['time'][0:2] + " UTC",fontproperties=prop)
-    if 'tp24' in allMeteogramData:
-        fig.text(0.2,0.06,"Forecast from the European Weather Centre from " + allMeteogramData['tp24']['date']+" at "+allMeteogramData['tp24']['time'][0:2] + ":" + allMeteogramData['tp24']['time'][0:2] + " UTC",fontproperties=prop)
-        #fig.text(0.1,0.03,allMeteogramData['tp24']['date']+"-"+allMeteogramData['tp24']['time'],fontproperties=prop)
-    fig.savefig("/tmp/" + filename, dpi=300, bbox_inches = 'tight')
-    pltclose(fig)
-    return filename
+        allMeteogramData = getMeteogramData(ensemble, meteogram = "15days", tzName = tzName)
+    return allMeteogramData, tzName
+
+def getMeteogramPng(latitude = None, longitude = None, altitude = None, location = None, days = 3, plotType = "enhanced-hres",
+                    resolved = None):
+    #resolved is the resolveRequest result of a request that already computed its etag
+    log.debug("meteogram latitude=%s longitude=%s location=%r days=%s plotType=%s",
+              latitude, longitude, location, days, plotType)
+    modelRun, place = resolved or resolveRequest(latitude, longitude, location, days)
+    key, (latitude, longitude, altitude, title) = getMeteogramKey(place, location, days, plotType)
+    image = renderCache.get(key, modelRun)
+    if image is not None:
+        return image
+    return renders.do((key, modelRun), makeMeteogramPng, key, modelRun, latitude, longitude, altitude, days, plotType, title)
+
+def makeMeteogramPng(key, modelRun, latitude, longitude, altitude, days, plotType, title):
+    allMeteogramData, tzName = getMeteogramInput(latitude, longitude, altitude, days)
+    with metrics.stage("render"):
+        image = renderPool.render(allMeteogramData, days, tzName, plotType, title)
+    renderCache.put(key, modelRun, image)
+    return image
+
+#version of the json meteogram api, bump it for incompatible changes of the payload
+METEOGRAM_API_VERSION = 1
+
+def compactList(values):
+    #the shortest decimals that read back as the same float32, missing values as null
+    return [None if value == 'nan' else float(value) for value in np.asarray(values, dtype = np.float32).astype(str).tolist()]
+
+def getMeteogramJson(latitude = None, longitude = None, altitude = None, location = None, days = 3, plotType = "enhanced-hres",
+                     resolved = None):
+    #gzipped json of everything a client needs to draw the meteogram itself.
+    #The payload is columnar: one list per series, all lists share the time axis.
+    modelRun, place = resolved or resolveRequest(latitude, longitude, location, days)
+    key, (latitude, longitude, altitude, title) = getMeteogramKey(place, location, days, plotType)
+    key = key + ("json",)
+    payload = renderCache.get(key, modelRun)
+    if payload is not None:
+        return payload
+    return renders.do((key, modelRun), makeMeteogramJson, key, modelRun, latitude, longitude, altitude, days, plotType, title)
+
+def makeMeteogramJson(key, modelRun, latitude, longitude, altitude, days, plotType, title):
+    allMeteogramData, tzName = getMeteogramInput(latitude, longitude, altitude, days)
+    with metrics.stage("series"):
+        meteogram = getMeteogramSeries(allMeteogramData, days, tzName, plotType)
+    data = {
+        "version": METEOGRAM_API_VERSION,
+        "title": title,
+        "latitude": latitude,
+        "longitude": longitude,
+        "altitude": altitude,
+        "plotType": plotType,
+        "modelRun": modelRun.strftime("%Y-%m-%dT%H:%MZ"),
+        "timezone": tzName,
+        "time": meteogram["time"].tolist(),
+        "utcOffset": meteogram["utcOffset"].tolist(),
+        "series": {name: {percentile: compactList(values) for percentile, values in series.items()}
+                   for name, series in meteogram["series"].items()},
+        "extrema": {key: indices.tolist() for key, indices in meteogram["extrema"].items()},
+        "symbols": {symbol: {"index": rows["index"].tolist(), "pictograms": rows["pictograms"]}
+                    for symbol, rows in meteogram["symbols"].items()},
+    }
+    payload = gzip.compress(json.dumps(data, separators = (",", ":")).encode("utf-8"))
+    renderCache.put(key, modelRun, payload)
+    return payload
@@ -0,0 +1,143 @@
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from app import app
+from .downloadJsonData import getModelRun, getForecastDays, fetchEnsembles
+from . import controller
+
+log = logging.getLogger(__name__)
+
+class PrewarmScheduler:
+    #renders the most requested meteograms again as soon as a new model run is available,
+    #so the first user after a run does not pay for fetching and rendering.
+    #Popularity is an exponentially decaying request count per
+    #(location, latitude, longitude, days, plotType, variant), variant is "png" or "json".
+    def __init__(self, topN = 200, concurrency = 1, pollSeconds = 60, maxSeconds = 1800,
+                 halfLifeHours = 24, maxTracked = 10000):
+        self.topN = topN
+        self.concurrency = concurrency
+        self.pollSeconds = pollSeconds
+        self.maxSeconds = maxSeconds
+        self.halfLife = halfLifeHours * 3600
+        self.maxTracked = maxTracked
+        self.scores = {}#request -> (score, last update)
+        self.liveRequests = 0
+        self.warmedRun = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def record(self, location, latitude, longitude, days, plotType, variant = "png"):
+        now = time.time()
+        key = (location, latitude, longitude, days, plotType, variant)
+        with self.lock:
+            score, last = self.scores.get(key, (0, now))
+            self.scores[key] = (score * 0.5 ** ((now - last) / self.halfLife) + 1, now)
+            if len(self.scores) > self.maxTracked:
+                #forget the least popular half
+                ranked = sorted(self.scores, key = lambda key: self.getScore(key, now))
+                for key in ranked[:len(ranked) // 2]:
+                    del self.scores[key]
+
+    def getScore(self, key, now):
+        score, last = self.scores[key]
+        return score * 0.5 ** ((now - last) / self.halfLife)
+
+    @contextmanager
+    def liveRequest(self):
+        #live requests have priority, warming waits while any of them is running
+        with self.lock:
+            self.liveRequests += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.liveRequests -= 1
+
+    def getTopRequests(self):
+        #all requested (days, plotType, variant) combinations of the topN most requested places
+        now = time.time()
+        with self.lock:
+            places = {}
+            for key in self.scores:
+                place = key[:3]
+                places.setdefault(place, [0, []])
+                places[place][0] += self.getScore(key, now)
+                places[place][1].append(key[3:])
+        ranked = sorted(places.items(), key = lambda item: item[1][0], reverse = True)
+        return [(place, combinations) for place, (_, combinations) in ranked[:self.topN]]
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target = self.run, name = "prewarm", daemon = True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            #the run open-meteo serves, warming a run it does not serve yet would cache the
+            #previous run's data
+            modelRun = getModelRun()
+            if self.warmedRun is None:
+                #the run that was current when the app started is warmed by live traffic
+                self.warmedRun = modelRun
+            elif modelRun > self.warmedRun:
+                self.warmedRun = modelRun
+                try:
+                    self.warm(modelRun)
+                except Exception:
+                    log.exception("prewarming failed")
+            time.sleep(self.pollSeconds)
+
+    def shouldStop(self, modelRun, deadline):
+        return time.time() > deadline or getModelRun() != modelRun
+
+    def waitForIdle(self, modelRun, deadline):
+        while self.liveRequests > 0:
+            if self.shouldStop(modelRun, deadline):
+                return False
+            time.sleep(0.1)
+        return not self.shouldStop(modelRun, deadline)
+
+    def warm(self, modelRun):
+        deadline = time.time() + self.maxSeconds
+        topRequests = self.getTopRequests()
+        if not topRequests or not self.waitForIdle(modelRun, deadline):
+            return
+        #as many forecast days as the longest meteogram needs, shorter ones are answered from it
+        days = max(combination[0] for _, combinations in topRequests for combination in combinations)
+        places = {}
+        for (location, latitude, longitude), _ in topRequests:
+            #a place that is not found (any more) or whose geocoding fails is skipped
+            try:
+                places[(location, latitude, longitude)] = controller.resolveCoordinates(latitude, longitude, location)
+            except Exception as e:
+                log.warning("prewarming location=%r latitude=%s longitude=%s failed: %r", location, latitude, longitude, e)
+        if not places:
+            return
+        #one batched upstream request for all places
+        fetchEnsembles([place[:2] for place in places.values()], getForecastDays(days))
+
+        def render(location, latitude, longitude, days, plotType, variant):
+            if not self.waitForIdle(modelRun, deadline):
+                return
+            make = controller.getMeteogramJson if variant == "json" else controller.getMeteogramPng
+            try:
+                make(latitude = latitude, longitude = longitude,
+                     location = location, days = days, plotType = plotType)
+            except Exception as e:
+                log.warning("prewarming location=%r latitude=%s longitude=%s failed: %r", location, latitude, longitude, e)
+
+        with ThreadPoolExecutor(max_workers = self.concurrency) as pool:
+            for (location, latitude, longitude), combinations in topRequests:
+                if (location, latitude, longitude) not in places:
+                    continue
+                for days, plotType, variant in combinations:
+                    pool.submit(render, location, latitude, longitude, days, plotType, variant)
+
+scheduler = PrewarmScheduler(topN = app.config.get('PREWARM_TOP_N', 200),
+                             concurrency = app.config.get('PREWARM_CONCURRENCY', 1),
+                             pollSeconds = app.config.get('PREWARM_POLL_SECONDS', 60),
+                             maxSeconds = app.config.get('PREWARM_MAX_SECONDS', 1800))
@@ -0,0 +1,28 @@
+from collections import OrderedDict
+from .downloadJsonData import ModelRunCache
+from . import metrics
+
+class RenderCache(ModelRunCache):
+    #LRU cache of finished meteogram images for the current model run
+    #keys are (gridCell, days, plotType, title), values the png bytes.
+    #places maps a search (location name or lat/lon) to its resolved
+    #(latitude, longitude, altitude), so hits do not need geocoding either.
+    def __init__(self, maxEntries = 256, maxPlaces = 4096):
+        super().__init__(maxEntries, name = "render")
+        self.maxPlaces = maxPlaces
+        self.places = OrderedDict()
+
+    def getPlace(self, query):
+        with self.lock:
+            place = self.places.get(query)
+            if place is not None:
+                self.places.move_to_end(query)
+        metrics.countCache("place", place is not None)
+        return place
+
+    def putPlace(self, query, place):
+        with self.lock:
+            self.places[query] = place
+            self.places.move_to_end(query)
+            while len(self.places) > self.maxPlaces:
+                self.places.popitem(last = False)
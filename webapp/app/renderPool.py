@@ -0,0 +1,135 @@
+import multiprocessing
+import threading
+import queue
+import time
+import logging
+from .plotMeteogram import renderMeteogramPng, warmPictogramCache
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+def initWorker():
+    #matplotlib, the fonts and the pictograms are loaded once per worker
+    warmPictogramCache()
+
+def renderInWorker(allMeteogramData, days, tzName, plotType, title):
+    #the png and the metrics the worker recorded while making it, for the web server process
+    image = renderMeteogramPng(allMeteogramData, days, tzName, plotType, title)
+    return image, metrics.registry.drain()
+
+def serveRenders(connection):
+    #main loop of a worker process: one job at a time from the pipe, None stops it
+    initWorker()
+    while True:
+        try:
+            job = connection.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        try:
+            result = (True, renderInWorker(*job))
+        except Exception as e:
+            result = (False, e)
+        try:
+            connection.send(result)
+        except Exception as e:
+            #the exception of the render could not be pickled
+            connection.send((False, RuntimeError(repr(result[1]))))
+
+class RenderWorker:
+    #a process that renders the jobs sent through its pipe
+    def __init__(self, context):
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target = serveRenders, args = (child,),
+                                       name = "render", daemon = True)
+        self.process.start()
+        child.close()
+        self.jobs = 0
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.connection.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+class RenderPool:
+    #renders meteograms in separate processes, so every render has its own
+    #matplotlib state and renders can run on all cores.
+    #A render that takes longer than timeout seconds (waiting for a free worker included)
+    #raises TimeoutError, its worker is killed and replaced, as is a worker that crashed.
+    #Workers are replaced after jobsPerWorker renders to limit memory growth.
+    #With workers = 0 the meteograms are rendered in the calling process.
+    def __init__(self, workers = 2, timeout = 60, jobsPerWorker = 200):
+        self.workers = workers
+        self.timeout = timeout
+        self.jobsPerWorker = jobsPerWorker
+        self.idle = queue.Queue()#workers waiting for a job
+        self.started = 0
+        self.context = None
+        self.lock = threading.Lock()
+
+    def startWorker(self):
+        #spawn instead of fork, the web server process runs threads
+        if self.context is None:
+            self.context = multiprocessing.get_context("spawn")
+        return RenderWorker(self.context)
+
+    def checkout(self, deadline):
+        with self.lock:
+            start = self.idle.empty() and self.started < self.workers
+            if start:
+                self.started += 1
+        if start:
+            return self.startWorker()
+        while True:
+            try:
+                worker = self.idle.get(timeout = max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                raise TimeoutError("no render worker became free within %s seconds" % self.timeout)
+            if worker.process.is_alive():
+                return worker
+            #crashed while it was idle
+            log.warning("render worker pid=%s exited with %s, replacing it", worker.process.pid, worker.process.exitcode)
+            self.replace(worker)
+
+    def checkin(self, worker):
+        if worker.jobs >= self.jobsPerWorker:
+            worker.stop()
+            worker = self.startWorker()
+        self.idle.put(worker)
+
+    def replace(self, worker):
+        worker.kill()
+        self.idle.put(self.startWorker())
+
+    def render(self, allMeteogramData, days, tzName, plotType, title):
+        #png bytes of the meteogram, raises TimeoutError after timeout seconds
+        if self.workers == 0:
+            return renderMeteogramPng(allMeteogramData, days, tzName, plotType, title)
+        deadline = time.monotonic() + self.timeout
+        worker = self.checkout(deadline)
+        try:
+            worker.connection.send((allMeteogramData, days, tzName, plotType, title))
+            worker.jobs += 1
+            if not worker.connection.poll(max(0, deadline - time.monotonic())):
+                metrics.STAGE_TIMEOUTS.inc("render")
+                log.warning("render timeout=%ss pid=%s, replacing the worker", self.timeout, worker.process.pid)
+                raise TimeoutError("rendering took longer than %s seconds" % self.timeout)
+            ok, result = worker.connection.recv()
+        except BaseException:
+            #stuck, crashed or interrupted in the middle of a job
+            self.replace(worker)
+            raise
+        self.checkin(worker)
+        if not ok:
+            raise result
+        image, workerMetrics = result
+        metrics.registry.merge(workerMetrics)
+        return image
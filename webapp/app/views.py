@@ -1,13 +1,31 @@
-from flask import render_template,flash, redirect, request, jsonify
+from flask import render_template,flash, redirect, request, jsonify, url_for, Response, send_from_directory, g
 from flask_wtf import FlaskForm
 from wtforms import StringField, validators, SubmitField, DecimalField, IntegerField, RadioField
 from app import app, controller
 #from .models import 
 from random import randint
 import json
-from .controller import plotMeteogramFile
-from base64 import b64encode
+from .controller import resolveRequest, getMeteogramPng, getMeteogramEtag, getMeteogramJson
+from .plotMeteogram import PICTOGRAM_PATH
+import gzip
+from .prewarm import scheduler
+from . import metrics
 import os
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+@app.before_request
+def startRequestTimer():
+    g.requestStart = time.perf_counter()
+
+@app.after_request
+def recordRequest(response):
+    if 'requestStart' in g:
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - g.requestStart,
+                                        request.endpoint or "unknown", str(response.status_code))
+    return response
 
 class searchForm(FlaskForm):
     search = StringField("Search",  [validators.Optional()])
@@ -36,17 +54,14 @@ def search():
     #print('longitude: ' + request.form['longitude'])
     #form = searchForm(csrf_enable=False)
     #print(form)
-    print(request.args)
-    print([key for key in request.args.keys()])
+    log.debug("search method=%s args=%s", request.method, request.args)
     #print('latitude: ' +  request.form['lat'])
     #print('longitude: ' + request.form['lon'])
     form = searchForm()
     if request.method == 'GET':
-        print("lon", request.args['lon'])
         if request.args['search']:
             searchLocation = str(request.args['search'])
             form.search.data = searchLocation
-            print(searchLocation)
         else:
             searchLocation = ""
         if request.args['lat']:
@@ -71,23 +86,116 @@ def search():
         longitude = form.lon.data
         days = form.days.data
         plotType = form.plotType.data
-        print('location: ' +  searchLocation)
+        log.debug("search location=%r", searchLocation)
     else:
-        print("invalid form")
+        log.debug("search invalid form errors=%s", form.errors)
     if "latitude" in locals():
-        filename = plotMeteogramFile(latitude = latitude, longitude = longitude,
-                                     location = searchLocation,
-                                     days = days,
-                                     plotType = plotType)
-        with open("/tmp/"+filename, "rb") as fp:
-            fileContent = b64encode(fp.read())
-        #return jsonify( filename )
-        os.remove("/tmp/"+filename)
+        args = dict(search = searchLocation,
+                    lat = '' if latitude is None else latitude,
+                    lon = '' if longitude is None else longitude,
+                    days = days,
+                    plotType = plotType)
         return render_template("meteogram.html",
                 form = form,
                 plotType = form.plotType.data,
-                image = 'data:image/png;base64,{}'.format(fileContent.decode())
+                image = url_for('meteogramImage', **args),
+                interactive = url_for('meteogramClient', **args)
                 )
     return render_template("index.html",
                            title = 'VSUP - Meteogram',
                            form = form)
+
+
+def getMeteogramArgs():
+    #search, lat, lon, days and plotType of a meteogram url
+    searchLocation = request.args.get('search', '')
+    latitude = float(request.args['lat']) if request.args.get('lat') else None
+    longitude = float(request.args['lon']) if request.args.get('lon') else None
+    days = request.args.get('days', 3, type = int)
+    plotType = request.args.get('plotType', 'ensemble')
+    return searchLocation, latitude, longitude, days, plotType
+
+@app.route('/meteogram.png')
+def meteogramImage():
+    #the png of a meteogram, cacheable by browsers until the next model run is available
+    searchLocation, latitude, longitude, days, plotType = getMeteogramArgs()
+    if app.config.get('PREWARM_ENABLED'):
+        scheduler.start()
+        scheduler.record(searchLocation, latitude, longitude, days, plotType)
+    with scheduler.liveRequest():
+        resolved = resolveRequest(latitude, longitude, searchLocation, days)
+        etag, maxAge = getMeteogramEtag(resolved,
+                                        location = searchLocation,
+                                        days = days,
+                                        plotType = plotType)
+        if request.if_none_match.contains(etag):
+            response = Response(status = 304)
+        else:
+            response = Response(getMeteogramPng(latitude = latitude, longitude = longitude,
+                                                location = searchLocation,
+                                                days = days,
+                                                plotType = plotType,
+                                                resolved = resolved),
+                                mimetype = 'image/png')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = maxAge
+    return response
+
+
+@app.route('/api/v1/meteogram.json')
+def meteogramJson():
+    #the data of a meteogram for clients that draw it themselves, see controller.getMeteogramJson
+    searchLocation, latitude, longitude, days, plotType = getMeteogramArgs()
+    if app.config.get('PREWARM_ENABLED'):
+        scheduler.start()
+        scheduler.record(searchLocation, latitude, longitude, days, plotType, "json")
+    with scheduler.liveRequest():
+        resolved = resolveRequest(latitude, longitude, searchLocation, days)
+        etag, maxAge = getMeteogramEtag(resolved,
+                                        location = searchLocation,
+                                        days = days,
+                                        plotType = plotType,
+                                        variant = "json")
+        if request.if_none_match.contains(etag):
+            response = Response(status = 304)
+        else:
+            payload = getMeteogramJson(latitude = latitude, longitude = longitude,
+                                       location = searchLocation,
+                                       days = days,
+                                       plotType = plotType,
+                                       resolved = resolved)
+            if request.accept_encodings['gzip']:
+                response = Response(payload, mimetype = 'application/json')
+                response.content_encoding = 'gzip'
+            else:
+                response = Response(gzip.decompress(payload), mimetype = 'application/json')
+    response.vary.add('Accept-Encoding')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = maxAge
+    return response
+
+@app.route('/pictogram/<path:filename>')
+def pictogram(filename):
+    return send_from_directory(os.path.abspath(PICTOGRAM_PATH), filename, max_age = 86400)
+
+@app.route('/meteogram')
+def meteogramClient():
+    #a meteogram drawn in the browser from /api/v1/meteogram.json
+    searchLocation, latitude, longitude, days, plotType = getMeteogramArgs()
+    return render_template("meteogramClient.html",
+                           title = 'VSUP - Meteogram',
+                           plotType = plotType,
+                           data = url_for('meteogramJson',
+                                          search = searchLocation,
+                                          lat = '' if latitude is None else latitude,
+                                          lon = '' if longitude is None else longitude,
+                                          days = days,
+                                          plotType = plotType),
+                           pictograms = url_for('pictogram', filename = ''))
+
+@app.route('/metrics')
+def metricsText():
+    #latencies per stage, cache hits and upstream traffic in the Prometheus text format
+    return Response(metrics.render(), mimetype = 'text/plain; version=0.0.4')
@@ -0,0 +1,254 @@
+#offline benchmark of downloading, parsing and plotting meteograms
+#
+#  python benchmark/benchmark.py                            timings as json on stdout
+#  python benchmark/benchmark.py --output results.json      ... into a file
+#  python benchmark/benchmark.py --save-baseline benchmark/baseline.json
+#  python benchmark/benchmark.py --baseline benchmark/baseline.json [--threshold 1.25]
+#
+#The Open-Meteo responses, geocoding and elevations are read from benchmark/fixtures,
+#every network connection is refused. The ensemble in the repository is synthetic
+#(see synthesize.py), record.py records real ones. Geocoding and elevation are looked
+#up in places.json, so getCoordinates[geocode=fixture] times the option handling
+#around geocode, not a geocoder. With --baseline the exit code
+#is 1 if any median is more than threshold times slower than in the baseline.
+#Timings are in milliseconds and only comparable on the same machine.
+import sys, os, io, gzip, json, time, getopt, platform, socket, statistics, contextlib
+from datetime import datetime, timedelta
+
+BENCHMARK_PATH = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_PATH = os.path.join(BENCHMARK_PATH, "fixtures")
+WEBAPP_PATH = os.path.dirname(BENCHMARK_PATH)
+#plotMeteogram reads the pictograms relative to the working directory
+os.chdir(WEBAPP_PATH)
+sys.path.insert(0, WEBAPP_PATH)
+
+DAYS = [3, 7, 10, 15]
+PLOT_TYPES = ["ensemble", "enhanced-hres"]
+REPEAT = 5
+THRESHOLD = 1.25
+#differences below this many milliseconds are timer noise, not regressions
+NOISE_FLOOR = 1.0
+
+def refuseConnection(*args, **kwargs):
+    raise OSError("the benchmark runs without network")
+
+def blockNetwork():
+    socket.socket.connect = refuseConnection
+    socket.create_connection = refuseConnection
+    socket.getaddrinfo = refuseConnection
+
+class FixtureResponse:
+    status_code = 200
+
+    def __init__(self, content):
+        self.content = content
+
+    def raise_for_status(self):
+        pass
+
+class FixtureSession:
+    #answers Open-Meteo requests with the fixture responses of the requested grid cells
+    def __init__(self, responses):
+        self.responses = responses#grid cell -> response body
+        self.requests = 0
+
+    def request(self, method, url, params = None, data = None, **kwargs):
+        from downloadJsonData import getGridCell
+        params = params if params is not None else data
+        latitudes = params["latitude"] if isinstance(params["latitude"], list) else [params["latitude"]]
+        longitudes = params["longitude"] if isinstance(params["longitude"], list) else [params["longitude"]]
+        self.requests += 1
+        return FixtureResponse(b"".join(self.responses[getGridCell(latitude, longitude)]
+                                        for latitude, longitude in zip(latitudes, longitudes)))
+
+    def close(self):
+        pass
+
+def loadFixtures():
+    from downloadJsonData import getGridCell
+    with open(os.path.join(FIXTURE_PATH, "places.json")) as fp:
+        places = json.load(fp)
+    responses = {}
+    for place in places:
+        with open(os.path.join(FIXTURE_PATH, place["ensemble"]), "rb") as fp:
+            responses[getGridCell(place["latitude"], place["longitude"])] = gzip.decompress(fp.read())
+    return places, responses
+
+def installFixtures(places, responses):
+    #geocoding, elevation and the ensemble download of downloadJsonData answer from the fixtures
+    import openmeteo_requests
+    import downloadJsonData
+    geocodes = {downloadJsonData.normalizeQuery(place["query"]): (place["latitude"], place["longitude"]) for place in places}
+    elevations = {(place["latitude"], place["longitude"]): place["elevation"] for place in places}
+    downloadJsonData.geocode = lambda query: geocodes[downloadJsonData.normalizeQuery(query)]
+    downloadJsonData.getElevation = lambda latitude, longitude: elevations.get((latitude, longitude))
+    downloadJsonData.openmeteo = openmeteo_requests.Client(session = FixtureSession(responses))
+    downloadJsonData.FORECAST_STORE_PATH = ""
+
+def measure(function, repeat, setup = None):
+    #min and median milliseconds of function(*setup()), setup is not timed
+    times = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            arguments = setup() if setup is not None else ()
+            start = time.perf_counter()
+            function(*arguments)
+            times.append(time.perf_counter() - start)
+    return {"min": round(min(times) * 1000, 3), "median": round(statistics.median(times) * 1000, 3)}
+
+def addHres(allMeteogramData):
+    #the Open-Meteo ensemble has no hres run, the median stands in for it so the
+    #enhanced-hres drawing can be timed
+    for name in allMeteogramData:
+        allMeteogramData[name][name]["hres"] = allMeteogramData[name][name]["median"]
+    return allMeteogramData
+
+def savefig(fig, layout):
+    #like renderMeteogramPng, the figure is reused by the next render of the layout
+    import plotMeteogram as pm
+    fig.savefig(io.BytesIO(), format = "png", dpi = pm.RENDER_DPI, bbox_inches = "tight")
+    pm.checkinFigure(layout, fig)
+
+def runBenchmarks(repeat = REPEAT, daysList = DAYS, plotTypes = PLOT_TYPES):
+    import pandas as pd
+    import downloadJsonData as dl
+    import plotMeteogram as pm
+    places, responses = loadFixtures()
+    installFixtures(places, responses)
+    place = places[0]
+    latitude, longitude, tzName = place["latitude"], place["longitude"], place["timezone"]
+    results = {}
+
+    def getData(meteogram = "10days", days = None):
+        return dl.getData(longitude, latitude, place["elevation"], writeToFile = False, meteogram = meteogram, days = days, tzName = tzName)
+
+    def emptyCache():
+        dl.ensembleCache = dl.ModelRunCache(maxEntries = 128)
+        return ()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        response = dl.openmeteo.weather_api(dl.url, params = dl.getEnsembleParams([dl.getGridCell(latitude, longitude)]))[0]
+        ensemble = dl.parseEnsemble(response)
+    results["getCoordinates[geocode=fixture]"] = measure(dl.getCoordinates, repeat, lambda: ([("--location", place["query"])],))
+    results["parseEnsemble"] = measure(dl.parseEnsemble, repeat, lambda: (response,))
+    results["getData"] = measure(getData, repeat, emptyCache)
+    members = {"date": ensemble["dates"]}
+    for i, variable in enumerate(ensemble["variables"]):
+        for member in range(ensemble["cube"].shape[1]):
+            members[f"{variable}_member{member}"] = ensemble["cube"][i, member]
+    members = pd.DataFrame(members)
+    results["calculate_percentiles"] = measure(dl.calculate_percentiles, repeat, lambda: (members, "temperature_2m"))
+    percentiles = dl.calculate_percentiles(members, "temperature_2m")
+    results["create_dictionary"] = measure(dl.create_dictionary, repeat, lambda: (percentiles, "2t", 6))
+    results["getMeteogramData[15days]"] = measure(dl.getMeteogramData, repeat, lambda: (ensemble, "15days", tzName))
+
+    pm.warmPictogramCache(daysList)
+    today = pd.Timestamp(ensemble["dates"][0]).tz_localize(None).to_pydatetime() + timedelta(hours = 3)
+    for days in daysList:
+        for plotType in plotTypes:
+            label = "[days=%d,plotType=%s]" % (days, plotType)
+            #like the web app, more than 10 days get the daily meteogram
+            daily = days > 10
+            with contextlib.redirect_stdout(io.StringIO()):
+                data = addHres(getData("15days" if daily else "10days", days))
+                fromIndex, toIndex = pm.getTimeFrame(data, today, today + timedelta(days))
+            #plotMeteogram starts the 6 hourly meteogram at the second step
+            suffix = "24" if daily else ""
+            fromIndex = 0 if daily else 1
+            rows = [("plotCloudVSUP", pm.plotCloudVSUP, data["tcc" + suffix]["tcc" + suffix]),
+                    ("plotPrecipitationVSUP", pm.plotPrecipitationVSUP, data["tp" + suffix]["tp" + suffix]),
+                    ("plotWindBft", pm.plotWindBft, data["ws" + suffix]["ws" + suffix])]
+            for name, function, qdata in rows:
+                results[name + label] = measure(function, repeat,
+                    lambda qdata = qdata: (pm.createFigure(pyplot = False)[1][0], qdata, fromIndex, toIndex, plotType))
+            if not daily:
+                results["plotTemperature" + label] = measure(pm.plotTemperature, repeat,
+                    lambda: (pm.createFigure(pyplot = False)[1][2], data["2t"], 1, toIndex, tzName, plotType))
+            layout = (days, plotType)
+            results["plotMeteogram" + label] = measure(
+                lambda *args: pm.checkinFigure(layout, pm.plotMeteogram(*args)), repeat,
+                lambda: (data, 0, toIndex, tzName, plotType, layout))
+            results["savefig" + label] = measure(savefig, repeat,
+                lambda: (pm.plotMeteogram(data, 0, toIndex, tzName, plotType, layout), layout))
+            results["renderMeteogramPng" + label] = measure(pm.renderMeteogramPng, repeat,
+                lambda: (data, days, tzName, plotType, "Benchmark", today))
+    return results
+
+def getEnvironment(repeat):
+    import numpy, pandas, matplotlib
+    return {"python": platform.python_version(),
+            "numpy": numpy.__version__,
+            "pandas": pandas.__version__,
+            "matplotlib": matplotlib.__version__,
+            "machine": platform.machine(),
+            "platform": platform.platform(),
+            "repeat": repeat,
+            "date": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")}
+
+def compare(results, baseline, threshold):
+    #slower benchmarks (median above threshold times the baseline median and at least
+    #NOISE_FLOOR ms slower), printed as a table
+    regressions = []
+    print("%-60s %12s %12s %8s" % ("benchmark", "baseline ms", "current ms", "ratio"), file = sys.stderr)
+    for name, result in results.items():
+        if name not in baseline:
+            print("%-60s %12s %12.3f %8s" % (name, "-", result["median"], "new"), file = sys.stderr)
+            continue
+        ratio = result["median"] / max(baseline[name]["median"], 1e-6)
+        flag = ""
+        if ratio > threshold and result["median"] - baseline[name]["median"] > NOISE_FLOOR:
+            regressions.append(name)
+            flag = "  slower"
+        print("%-60s %12.3f %12.3f %8.2f%s" % (name, baseline[name]["median"], result["median"], ratio, flag), file = sys.stderr)
+    return regressions
+
+def usage():
+    print("benchmark.py [--repeat 5] [--days 3,7,10,15] [--output results.json]")
+    print("             [--save-baseline baseline.json] [--baseline baseline.json [--threshold 1.25]]")
+
+if __name__ == '__main__':
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "h", ["repeat=", "days=", "output=", "baseline=", "save-baseline=", "threshold="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    repeat = REPEAT
+    daysList = DAYS
+    output = None
+    baselineFile = None
+    saveBaseline = None
+    threshold = THRESHOLD
+    for opt, arg in opts:
+        if opt == "-h":
+            usage()
+            sys.exit(0)
+        elif opt == "--repeat":
+            repeat = int(arg)
+        elif opt == "--days":
+            daysList = [int(days) for days in arg.split(",")]
+        elif opt == "--output":
+            output = arg
+        elif opt == "--baseline":
+            baselineFile = arg
+        elif opt == "--save-baseline":
+            saveBaseline = arg
+        elif opt == "--threshold":
+            threshold = float(arg)
+    blockNetwork()
+    report = {"environment": getEnvironment(repeat), "results": runBenchmarks(repeat, daysList)}
+    text = json.dumps(report, indent = 2)
+    if output:
+        with open(output, "w") as fp:
+            fp.write(text + "\n")
+    if saveBaseline:
+        with open(saveBaseline, "w") as fp:
+            fp.write(text + "\n")
+    if not output and not saveBaseline:
+        print(text)
+    if baselineFile:
+        with open(baselineFile) as fp:
+            baseline = json.load(fp)["results"]
+        regressions = compare(report["results"], baseline, threshold)
+        if regressions:
+            print(len(regressions), "benchmarks are slower than", threshold, "times the baseline", file = sys.stderr)
+            sys.exit(1)
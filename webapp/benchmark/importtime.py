@@ -0,0 +1,89 @@
+#cold start report: how long "import app" takes in a fresh interpreter and which modules it costs
+#
+#  python benchmark/importtime.py [--repeat 5] [--top 15] [--module app] [--output importtime.json]
+#
+#Every run is a new python process started with -X importtime. The report lists the
+#median wall time of the import, the slowest modules (cumulative, as python reports them)
+#and which of the heavy libraries were loaded by the import at all.
+import sys, os, json, getopt, statistics, subprocess
+
+BENCHMARK_PATH = os.path.dirname(os.path.abspath(__file__))
+WEBAPP_PATH = os.path.dirname(BENCHMARK_PATH)
+
+REPEAT = 5
+TOP = 15
+#loaded on first use by the request stages that need them, see preload
+HEAVY_MODULES = ["matplotlib", "pandas", "PIL", "geopy", "timezonefinder",
+                 "openmeteo_requests", "openmeteo_sdk", "retry_requests", "requests"]
+
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import %s
+seconds = time.perf_counter() - start
+print(json.dumps({"seconds": seconds, "loaded": [name for name in %r if name in sys.modules]}))
+"""
+
+def importOnce(module):
+    #wall seconds, loaded heavy modules and the per module times (microseconds) of one cold import
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", PROBE % (module, HEAVY_MODULES)],
+                            cwd = WEBAPP_PATH, capture_output = True, text = True, check = True)
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, selfTime, cumulative, name = [field.strip() for field in line.replace("import time:", "|", 1).split("|")]
+        modules[name] = (int(selfTime), int(cumulative))
+    probe = json.loads(result.stdout.strip().splitlines()[-1])
+    return probe["seconds"], probe["loaded"], modules
+
+def getReport(module = "app", repeat = REPEAT, top = TOP):
+    runs = [importOnce(module) for _ in range(repeat)]
+    seconds = [run[0] for run in runs]
+    names = set().union(*(run[2] for run in runs))
+    cumulative = {name: statistics.median(run[2][name][1] for run in runs if name in run[2]) for name in names}
+    selfTimes = {name: statistics.median(run[2][name][0] for run in runs if name in run[2]) for name in names}
+    slowest = sorted(names, key = lambda name: cumulative[name], reverse = True)[:top]
+    return {"module": module,
+            "python": sys.version.split()[0],
+            "repeat": repeat,
+            "median_ms": round(statistics.median(seconds) * 1000, 1),
+            "min_ms": round(min(seconds) * 1000, 1),
+            "modules": len(names),
+            "heavy_loaded": runs[-1][1],
+            "slowest": [{"module": name,
+                         "cumulative_ms": round(cumulative[name] / 1000, 1),
+                         "self_ms": round(selfTimes[name] / 1000, 1)} for name in slowest]}
+
+def printReport(report):
+    print("import %s: median %.1f ms, min %.1f ms over %d cold starts, %d modules" %
+          (report["module"], report["median_ms"], report["min_ms"], report["repeat"], report["modules"]))
+    print("heavy modules loaded:", ", ".join(report["heavy_loaded"]) or "none")
+    print("%-50s %14s %9s" % ("module", "cumulative ms", "self ms"))
+    for entry in report["slowest"]:
+        print("%-50s %14.1f %9.1f" % (entry["module"], entry["cumulative_ms"], entry["self_ms"]))
+
+if __name__ == '__main__':
+    opts, args = getopt.getopt(sys.argv[1:], "h", ["repeat=", "top=", "module=", "output="])
+    repeat = REPEAT
+    top = TOP
+    module = "app"
+    output = None
+    for opt, arg in opts:
+        if opt == "-h":
+            print("importtime.py [--repeat 5] [--top 15] [--module app] [--output importtime.json]")
+            sys.exit(0)
+        elif opt == "--repeat":
+            repeat = int(arg)
+        elif opt == "--top":
+            top = int(arg)
+        elif opt == "--module":
+            module = arg
+        elif opt == "--output":
+            output = arg
+    report = getReport(module, repeat, top)
+    printReport(report)
+    if output:
+        with open(output, "w") as fp:
+            json.dump(report, fp, indent = 2)
+            fp.write("\n")
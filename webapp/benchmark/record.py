@@ -0,0 +1,44 @@
+#records the fixtures of benchmark.py, needs network
+#
+#  python benchmark/record.py "Braunschweig Germany" [more places ...]
+#
+#Every place is geocoded, its elevation and timezone looked up and the raw Open-Meteo
+#ensemble response of its grid cell stored gzipped in benchmark/fixtures, so the
+#benchmark parses exactly the bytes the api sends. places.json is replaced, the
+#synthetic fixture of synthesize.py is no longer used afterwards.
+import sys, os, gzip, json, re
+import requests
+
+BENCHMARK_PATH = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_PATH = os.path.join(BENCHMARK_PATH, "fixtures")
+WEBAPP_PATH = os.path.dirname(BENCHMARK_PATH)
+os.chdir(WEBAPP_PATH)
+sys.path.insert(0, WEBAPP_PATH)
+
+import downloadJsonData as dl
+
+def recordPlace(query):
+    latitude, longitude = dl.geocode(query)
+    elevation = dl.getElevation(latitude, longitude)
+    timezone = dl.getTimezone(latitude, longitude)
+    response = requests.get(dl.url, params = dict(dl.getEnsembleParams([dl.getGridCell(latitude, longitude)]), format = "flatbuffers"), timeout = 60)
+    response.raise_for_status()
+    filename = "ensemble_" + re.sub("[^a-z0-9]+", "_", query.lower()).strip("_") + ".bin.gz"
+    with open(os.path.join(FIXTURE_PATH, filename), "wb") as fp:
+        fp.write(gzip.compress(response.content, 9, mtime = 0))
+    print(query, latitude, longitude, elevation, timezone, len(response.content), "bytes")
+    return {"query": query,
+            "latitude": latitude,
+            "longitude": longitude,
+            "elevation": elevation,
+            "timezone": timezone,
+            "ensemble": filename}
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('record.py "Braunschweig Germany" [more places ...]')
+        sys.exit(2)
+    places = [recordPlace(query) for query in sys.argv[1:]]
+    with open(os.path.join(FIXTURE_PATH, "places.json"), "w") as fp:
+        json.dump(places, fp, indent = 4)
+        fp.write("\n")
@@ -0,0 +1,93 @@
+#writes the synthetic fixture of benchmark.py, needs no network
+#
+#  python benchmark/synthesize.py
+#
+#The ensemble of benchmark/fixtures/synthetic_braunschweig.bin.gz is not a recorded
+#Open-Meteo response: 51 members of seeded random temperature, precipitation, cloud
+#cover and wind speed, hourly for 16 days from 2026-10-18 00 UTC, encoded as the
+#flatbuffers message the api sends. It has the size and layout of a real response, so
+#parsing and plotting cost about the same, but the weather is made up.
+#record.py replaces it with recorded responses where there is network.
+import os, gzip, json
+import numpy as np
+import flatbuffers
+from openmeteo_sdk.Variable import Variable
+
+BENCHMARK_PATH = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_PATH = os.path.join(BENCHMARK_PATH, "fixtures")
+
+START = 1792281600#2026-10-18 00:00 UTC
+HOURS = 16 * 24
+MEMBERS = 51
+SEED = 20261018
+#name -> (open-meteo variable, altitude)
+VARIABLES = {"temperature_2m": (Variable.temperature, 2),
+             "precipitation": (Variable.precipitation, 0),
+             "cloud_cover": (Variable.cloud_cover, 0),
+             "wind_speed_10m": (Variable.wind_speed, 10)}
+PLACE = {"query": "Braunschweig Germany",
+         "latitude": 52.2646577,
+         "longitude": 10.5236066,
+         "elevation": 79,
+         "timezone": "Europe/Berlin",
+         "ensemble": "synthetic_braunschweig.bin.gz"}
+
+def makeSeries(name, rng):
+    t = np.arange(HOURS)
+    spread = 0.3 + t / 80
+    if name == "temperature_2m":
+        values = 9 + 5 * np.sin((t - 9) / 24 * 2 * np.pi) - t / 200
+        values = values + np.cumsum(rng.normal(0, 0.15, HOURS)) * spread / 3 + rng.normal(0, 0.4, HOURS)
+        return np.round(values, 1)
+    if name == "precipitation":
+        return np.round(np.clip(rng.gamma(0.25, 1.2, HOURS) - 0.3, 0, None), 1)
+    if name == "cloud_cover":
+        return np.round(np.clip(60 + np.cumsum(rng.normal(0, 6, HOURS)), 0, 100))
+    return np.round(np.abs(4 + 2 * np.sin(t / 37) + np.cumsum(rng.normal(0, 0.3, HOURS)) * spread / 4), 1)
+
+def makeResponse():
+    #length prefixed WeatherApiResponse, field numbers as in the openmeteo_sdk schema
+    rng = np.random.default_rng(SEED)
+    builder = flatbuffers.Builder(1 << 20)
+    series = []
+    for name, (variable, altitude) in VARIABLES.items():
+        for member in range(MEMBERS):
+            values = builder.CreateNumpyVector(makeSeries(name, rng).astype('<f4'))
+            builder.StartObject(12)#VariableWithValues
+            builder.PrependUint8Slot(0, variable, 0)
+            builder.PrependUOffsetTRelativeSlot(3, values, 0)
+            builder.PrependInt16Slot(5, altitude, 0)
+            builder.PrependInt16Slot(10, member, 0)
+            series.append(builder.EndObject())
+    builder.StartVector(4, len(series), 4)
+    for offset in reversed(series):
+        builder.PrependUOffsetTRelative(offset)
+    variables = builder.EndVector()
+    builder.StartObject(4)#VariablesWithTime
+    builder.PrependInt64Slot(0, START, 0)
+    builder.PrependInt64Slot(1, START + HOURS * 3600, 0)
+    builder.PrependInt32Slot(2, 3600, 0)
+    builder.PrependUOffsetTRelativeSlot(3, variables, 0)
+    hourly = builder.EndObject()
+    timezone = builder.CreateString(PLACE["timezone"])
+    abbreviation = builder.CreateString("GMT+2")
+    builder.StartObject(14)#WeatherApiResponse
+    builder.PrependFloat32Slot(0, 52.25, 0)#latitude and longitude of the grid cell
+    builder.PrependFloat32Slot(1, 10.5, 0)
+    builder.PrependFloat32Slot(2, PLACE["elevation"], 0)
+    builder.PrependInt32Slot(6, 7200, 0)#utc offset seconds
+    builder.PrependUOffsetTRelativeSlot(7, timezone, 0)
+    builder.PrependUOffsetTRelativeSlot(8, abbreviation, 0)
+    builder.PrependUOffsetTRelativeSlot(11, hourly, 0)
+    builder.Finish(builder.EndObject())
+    message = bytes(builder.Output())
+    return len(message).to_bytes(4, 'little') + message
+
+if __name__ == '__main__':
+    body = makeResponse()
+    with open(os.path.join(FIXTURE_PATH, PLACE["ensemble"]), "wb") as fp:
+        fp.write(gzip.compress(body, 9, mtime = 0))
+    with open(os.path.join(FIXTURE_PATH, "places.json"), "w") as fp:
+        json.dump([PLACE], fp, indent = 4)
+        fp.write("\n")
+    print(PLACE["ensemble"], len(body), "bytes")
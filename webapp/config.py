@@ -6,3 +6,57 @@ SECRET_KEY = 'bux0fohngaeva6ree2Fie7tie'
 
 
 
+#number of rendered meteograms kept in memory
+RENDER_CACHE_SIZE = 256
+#the files the app writes, next to this file unless METEOGRAM_DATA_PATH is set
+DATA_PATH = os.environ.get("METEOGRAM_DATA_PATH",
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+#geocoding: sorted offline place name index (built with
+#downloadJsonData.py --build-gazetteer) and the persistent Nominatim cache
+GAZETTEER_PATH = os.path.join(DATA_PATH, "gazetteer.tsv")
+GEOCODE_CACHE_PATH = os.path.join(DATA_PATH, "geocode.sqlite")
+#forecast days requested from open-meteo, a meteogram gets the shortest that covers it.
+#The ecmwf ensemble ends after 15 days, 16 covers the last local day of the 15 days meteogram
+FORECAST_DAYS = [4, 8, 11, 14, 16]
+#downloaded ensembles of the newest model runs, shared by all processes
+FORECAST_STORE_PATH = os.path.join(DATA_PATH, "forecasts")
+FORECAST_STORE_RUNS = 2
+#seconds between two checks which model run open-meteo serves, all caches are keyed on it
+MODEL_META_REFRESH_SECONDS = 60
+#timezones resolved per forecast grid cell kept in memory
+TIMEZONE_CACHE_SIZE = 100000
+#elevation: "dem" (SRTM .hgt tiles in DEM_PATH) or "open-elevation"
+ELEVATION_PROVIDER = "dem"
+ELEVATION_HTTP_FALLBACK = True
+DEM_PATH = "dem/"
+#re-render the most requested meteograms when a new model run is available
+PREWARM_ENABLED = True
+PREWARM_TOP_N = 200
+#meteograms warmed at the same time, the renders share the RENDER_WORKERS render
+#processes with the live requests, more than RENDER_WORKERS does not help
+PREWARM_CONCURRENCY = 1
+PREWARM_POLL_SECONDS = 60
+#give up warming a run after this many seconds
+PREWARM_MAX_SECONDS = 1800
+#render worker processes (0 renders in the web server process), seconds a
+#render may take and renders after which a worker is replaced
+RENDER_WORKERS = 2
+RENDER_TIMEOUT = 60
+RENDER_JOBS_PER_WORKER = 200
+#threads for the concurrent i/o of requests and the seconds each stage may take,
+#a slow elevation gives -999 m and a slow timezone lookup UTC
+PIPELINE_WORKERS = 16
+GEOCODE_STAGE_TIMEOUT = 10
+ELEVATION_STAGE_TIMEOUT = 2
+DOWNLOAD_STAGE_TIMEOUT = 30
+TIMEZONE_STAGE_TIMEOUT = 5
+#seconds the connection to open-meteo and each read of an ensemble answer may take, per
+#attempt of the 5 retries. The stage timeouts above only stop a request from waiting for it
+ENSEMBLE_TIMEOUT = 30
+#seconds a request or prewarm batch waits for a grid cell another thread downloads
+ENSEMBLE_WAIT_TIMEOUT = 60
+#DEBUG logs every request and stage, the timings are always in /metrics
+LOG_LEVEL = "WARNING"
+#web server processes forked from a warm parent by run.py --prefork, each has its own
+#render workers, memory caches and metrics, the forecast store is shared
+PREFORK_WORKERS = 4
@@ -1,70 +1,681 @@
 from datetime import date, timedelta, datetime
-import time, json, sys
+import time, json, sys, logging
+import threading, os, mmap, sqlite3, unicodedata, re, fcntl, shutil, functools
+from collections import OrderedDict
+from concurrent.futures import Future
 from pathlib import Path
-from geopy.geocoders import Nominatim
-import requests
 import getopt
 import numpy as np
-import pandas as pd
+# requests, geopy, timezonefinder and the open-meteo client are imported by the
+# functions that need them, pandas only by the DataFrame helpers calculate_percentiles
+# and create_dictionary, importing this module stays cheap (see preload)
+try:
+    from . import metrics
+except ImportError:
+    import metrics
+
+log = logging.getLogger(__name__)
+ENSEMBLE_MEMBERS = 51
+PERCENTILES = [0, 10, 25, 50, 75, 90, 100]  # min, 10%, 25%, median, 75%, 90%, max
+PERCENTILE_NAMES = ['min', 'ten', 'twenty_five', 'median', 'seventy_five', 'ninety', 'max']
+# probability of the members exceeding these values is computed along with the percentiles
+EXCEEDANCE_THRESHOLDS = {"precipitation": 1.0, "wind_speed_10m": 17.2}  # mm, m/s (Bft 8)
+
+def calculate_quantiles(cube, percentiles=PERCENTILES, thresholds=None):
+    # cube has the shape (variable, member, time), a (member, time) array is also accepted
+    # returns the percentiles as (variable, percentile, time) and, if thresholds (one value
+    # or None per variable) are given, the exceedance probabilities as (variable, time)
+    cube = np.asarray(cube)
+    squeeze = cube.ndim == 2
+    if squeeze:
+        cube = cube[np.newaxis]
+    # sort the members of every cell once, all percentiles and probabilities are read from it
+    sortedCube = np.sort(cube, axis=1)
+    nMembers = cube.shape[1]
+    # linear interpolation between the closest ranks, like np.percentile
+    position = np.asarray(percentiles, dtype=float) / 100 * (nMembers - 1)
+    lower = np.floor(position).astype(int)
+    upper = np.minimum(lower + 1, nMembers - 1)
+    fraction = (position - lower)[np.newaxis, :, np.newaxis]
+    lowerValues = sortedCube[:, lower, :]
+    quantiles = lowerValues + (sortedCube[:, upper, :] - lowerValues) * fraction
+    # sorting moves NaNs to the end, np.percentile returns NaN for such cells
+    quantiles[np.broadcast_to(np.isnan(sortedCube[:, -1:, :]), quantiles.shape)] = np.nan
+    if thresholds is None:
+        return quantiles[0] if squeeze else quantiles
+    probabilities = np.full((cube.shape[0], cube.shape[2]), np.nan)
+    for i, threshold in enumerate(thresholds):
+        if threshold is not None:
+            probabilities[i] = (sortedCube[i] > threshold).sum(axis=0) / nMembers
+    if squeeze:
+        return quantiles[0], probabilities[0]
+    return quantiles, probabilities
+
 
 def calculate_percentiles(df, column_string="temperature_2m"):
-    # Select only the 51 temperature columns
-    temp_cols = [f'{column_string}_member{i}' for i in range(51)]
+    # Select only the 51 ensemble member columns
+    temp_cols = [f'{column_string}_member{i}' for i in range(ENSEMBLE_MEMBERS)]
+    import pandas as pd
     temps = df[temp_cols].to_numpy()
 
     # Compute the required percentiles
-    percentiles = [0, 10, 25, 50, 75, 90, 100]  # min, 10%, 25%, median, 75%, 90%, max
-    percentile_values = np.percentile(temps, percentiles, axis=1).T
+    percentile_values = calculate_quantiles(temps.T).T
 
     # Create a DataFrame with the percentile results
-    percentile_df = pd.DataFrame(
-        percentile_values,
-        columns=['min', 'ten', 'twenty_five', 'median', 'seventy_five', 'ninety', 'max']
-    )
+    percentile_df = pd.DataFrame(percentile_values, columns=PERCENTILE_NAMES)
 
     # Concatenate with the date or any other columns you want to retain
     result = pd.concat([df[['date']], percentile_df], axis=1)
-
-    print(result.head())
     return(result)
 
 
-def create_dictionary(df, name="2t", step_interval=1):
-    n_steps = len(df)
-    step_size_hours = int((df['date'].iloc[1] - df['date'].iloc[0]).total_seconds() / 3600)
-
-    # Select every nth row using the step_interval
-    selected_rows = df.iloc[::step_interval]
+def create_quantile_dictionary(quantiles, dates, name="2t", step_interval=1, probabilities=None):
+    # quantiles has the shape (percentile, time) and dates holds the times of all rows
+    n_steps = len(dates)
+    step_size_hours = int((dates[1] - dates[0]) / np.timedelta64(1, 'h'))
     selected_indices = range(0, n_steps, step_interval)
 
     # Generate the 'steps' list dynamically based on the index positions selected
     steps = [str(i * step_size_hours) for i in selected_indices]
 
-    first_date = pd.to_datetime(df['date'].iloc[0])
+    first_date = dates[0].astype('datetime64[s]').astype(datetime)
 
     output = {
-        name: {
-            "max": selected_rows['max'].tolist(),
-            "median": selected_rows['median'].tolist(),
-            "min": selected_rows['min'].tolist(),
-            "ninety": selected_rows['ninety'].tolist(),
-            "seventy_five": selected_rows['seventy_five'].tolist(),
-            "ten": selected_rows['ten'].tolist(),
-            "twenty_five": selected_rows['twenty_five'].tolist(),
-            "steps": steps,
-        },
+        name: {key: quantiles[i, ::step_interval].tolist() for i, key in enumerate(PERCENTILE_NAMES)},
         "date": first_date.strftime('%Y%m%d'),
         "time": first_date.strftime('%H%M')
     }
-
+    output[name]["steps"] = steps
+    if probabilities is not None:
+        output[name]["exceedance"] = probabilities[::step_interval].tolist()
     return output
 
-def getElevation(latitude: int,longitute: int):
+
+def create_dictionary(df, name="2t", step_interval=1):
+    quantiles = df[PERCENTILE_NAMES].to_numpy().T
+    dates = df['date'].to_numpy()
+    return create_quantile_dictionary(quantiles, dates, name, step_interval)
+
+# open-meteo serves ecmwf_ifs025 on a 0.25° grid, all points inside one cell get the same data
+GRID_RESOLUTION = 0.25
+# a new ensemble run is started every 6 hours and is available some hours later
+MODEL_RUN_INTERVAL_HOURS = 6
+MODEL_RUN_DELAY_HOURS = 8
+
+def getGridCell(latitude, longitude):
+    return (round(round(float(latitude) / GRID_RESOLUTION) * GRID_RESOLUTION, 2),
+            round(round(float(longitude) / GRID_RESOLUTION) * GRID_RESOLUTION, 2))
+
+def getLatestModelRun(now = None):
+    # start time (UTC) of the newest run that should be available at now
+    if now is None:
+        now = datetime.utcnow()
+    available = now - timedelta(hours = MODEL_RUN_DELAY_HOURS)
+    return datetime(available.year, available.month, available.day,
+                    available.hour - available.hour % MODEL_RUN_INTERVAL_HOURS)
+
+# open-meteo's metadata of the ensemble model, last_run_initialisation_time is the start
+# (unix time) of the newest run it serves
+MODEL_META_URL = "https://ensemble-api.open-meteo.com/data/ecmwf_ifs025_ensemble/static/meta.json"
+MODEL_META_TIMEOUT = 10  # seconds
+
+def getUpstreamModelRun():
+    # start time (UTC) of the newest run open-meteo serves, getLatestModelRun only estimates it
+    import requests
+    response = requests.get(MODEL_META_URL, timeout = MODEL_META_TIMEOUT,
+                            hooks = {"response": metrics.countUpstream("open-meteo-meta")})
+    response.raise_for_status()
+    return datetime.utcfromtimestamp(int(response.json()["last_run_initialisation_time"]))
+
+# seconds between two checks of the run open-meteo serves
+MODEL_META_REFRESH_SECONDS = 60
+_upstreamRun = None  # (newest run open-meteo serves or None, time.monotonic() it was asked for)
+_upstreamRunLock = threading.Lock()
+
+def refreshUpstreamModelRun():
+    global _upstreamRun
+    try:
+        upstreamRun = getUpstreamModelRun()
+    except Exception as e:
+        log.warning("checking the model run open-meteo serves failed: %r", e)
+        # the last answer is kept
+        upstreamRun = _upstreamRun[0] if _upstreamRun is not None else None
+    _upstreamRun = (upstreamRun, time.monotonic())
+
+def getModelRun():
+    # start time (UTC) of the run the meteograms are made from and all caches are keyed on:
+    # the run getLatestModelRun expects, unless open-meteo does not serve it yet. Otherwise
+    # the previous run's data would be cached, stored and served as the new run.
+    # The first call asks open-meteo, later calls use the last answer and ask again in a
+    # background thread once it is older than MODEL_META_REFRESH_SECONDS.
+    estimate = getLatestModelRun()
+    if _upstreamRun is None:
+        with _upstreamRunLock:
+            if _upstreamRun is None:
+                refreshUpstreamModelRun()
+    elif time.monotonic() - _upstreamRun[1] > MODEL_META_REFRESH_SECONDS and _upstreamRunLock.acquire(blocking = False):
+        def refresh():
+            try:
+                refreshUpstreamModelRun()
+            finally:
+                _upstreamRunLock.release()
+        threading.Thread(target = refresh, name = "model-run", daemon = True).start()
+    upstreamRun = _upstreamRun[0]
+    if upstreamRun is None:
+        return estimate
+    return min(estimate, upstreamRun)
+
+def getModelRunExpiry(modelRun):
+    # time (UTC) at which the run after modelRun becomes available
+    return modelRun + timedelta(hours = MODEL_RUN_INTERVAL_HOURS + MODEL_RUN_DELAY_HOURS)
+
+class ModelRunCache:
+    # LRU cache whose entries are only valid for the model run they were stored with,
+    # once a newer run is available all older entries are dropped.
+    # Lookups of a named cache are counted in the metrics.
+    def __init__(self, maxEntries = 128, name = None):
+        self.maxEntries = maxEntries
+        self.name = name
+        self.entries = OrderedDict()  # key -> (modelRun, value)
+        self.modelRun = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def setModelRun(self, modelRun):
+        with self.lock:
+            if self.modelRun is not None and modelRun <= self.modelRun:
+                return
+            self.modelRun = modelRun
+            for key in [key for key, entry in self.entries.items() if entry[0] < modelRun]:
+                del self.entries[key]
+
+    def get(self, key, modelRun, accept = None):
+        # accept(value) can turn down an entry of the model run, e.g. one that is too short
+        self.setModelRun(modelRun)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == modelRun and (accept is None or accept(entry[1])):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                hit = True
+            else:
+                self.misses += 1
+                hit = False
+        if self.name is not None:
+            metrics.countCache(self.name, hit)
+        return entry[1] if hit else None
+
+    def put(self, key, modelRun, value, replace = None):
+        # replace(value) decides whether an entry of the same model run is replaced
+        self.setModelRun(modelRun)
+        with self.lock:
+            if modelRun < self.modelRun:
+                return
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == modelRun and replace is not None and not replace(entry[1]):
+                return
+            self.entries[key] = (modelRun, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last = False)
+
+    def __len__(self):
+        return len(self.entries)
+
+class SingleFlight:
+    # concurrent calls with the same key share one computation: the first caller (the
+    # leader) computes, the others wait for its result or get its exception.
+    # Callers that come after the leader finished compute again, caching is up to the caller.
+    def __init__(self, name):
+        self.name = name
+        self.calls = {}  # key -> Future of the computation in flight
+        self.lock = threading.Lock()
+
+    def begin(self, key):
+        # (future, True) if the caller has to compute and then call finish, (future, False) if it can wait
+        with self.lock:
+            future = self.calls.get(key)
+            if future is not None:
+                metrics.COALESCED.inc(self.name)
+                return future, False
+            future = self.calls[key] = Future()
+            return future, True
+
+    def finish(self, key, future, result = None, exception = None):
+        with self.lock:
+            if self.calls.get(key) is future:
+                del self.calls[key]
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def do(self, key, function, *args):
+        future, leader = self.begin(key)
+        if not leader:
+            return future.result()
+        try:
+            result = function(*args)
+        except BaseException as e:
+            self.finish(key, future, exception = e)
+            raise
+        self.finish(key, future, result)
+        return result
+
+# directory of the files the app writes (forecast store, geocoding cache, gazetteer),
+# next to the code instead of the working directory, METEOGRAM_DATA_PATH moves it
+DATA_PATH = os.environ.get("METEOGRAM_DATA_PATH",
+                           os.path.join(os.path.dirname(os.path.realpath(__file__)), "data"))
+# on disk copy of the downloaded ensembles, shared by all processes, "" disables it
+FORECAST_STORE_PATH = os.path.join(DATA_PATH, "forecasts")
+# model runs kept on disk, older ones are deleted
+FORECAST_STORE_RUNS = 2
+
+class ForecastStore:
+    # float32 ensembles and their hourly quantiles per model run, appended to one file per
+    # run and read back as memory mapped views. index.jsonl maps a grid cell to its offset,
+    # the shapes and the time axis. Writers of all processes are serialized with flock.
+    def __init__(self, path, keepRuns = 2):
+        self.path = path
+        self.keepRuns = keepRuns
+        self.runs = {}  # run directory name -> {"index": cell -> entry, "indexSize", "data"}
+        self.lock = threading.Lock()
+
+    def getRun(self, modelRun):
+        name = modelRun.strftime("%Y%m%d%H")
+        if name not in self.runs:
+            self.runs[name] = {"index": {}, "indexSize": 0, "data": None}
+            # a process only keeps the runs it still reads
+            for old in sorted(self.runs)[:-self.keepRuns]:
+                del self.runs[old]
+        return os.path.join(self.path, name), self.runs[name]
+
+    def readIndex(self, directory, run):
+        # entries appended by any process since the last read
+        indexFile = os.path.join(directory, "index.jsonl")
+        if not os.path.exists(indexFile) or os.path.getsize(indexFile) == run["indexSize"]:
+            return
+        with open(indexFile, "rb") as fp:
+            fp.seek(run["indexSize"])
+            for line in fp:
+                if not line.endswith(b"\n"):
+                    # still being written
+                    break
+                entry = json.loads(line)
+                # a cell is stored again when a longer forecast is needed, the longest wins
+                old = run["index"].get(tuple(entry["cell"]))
+                if old is None or entry["cube"][2] >= old["cube"][2]:
+                    run["index"][tuple(entry["cell"])] = entry
+                run["indexSize"] += len(line)
+
+    def get(self, cell, modelRun, forecastDays = 0):
+        # None unless the cell is stored with at least forecastDays days
+        def covers(entry):
+            return entry is not None and entry["cube"][2] * entry["interval"] >= forecastDays * 86400
+        with self.lock:
+            directory, run = self.getRun(modelRun)
+            if not covers(run["index"].get(cell)):
+                self.readIndex(directory, run)
+            entry = run["index"].get(cell)
+            if not covers(entry):
+                return None
+            cubeShape, quantileShape = tuple(entry["cube"]), tuple(entry["quantiles"])
+            probabilityShape = (cubeShape[0], cubeShape[2])
+            sizes = [int(np.prod(shape)) for shape in (cubeShape, quantileShape, probabilityShape)]
+            start = entry["offset"] // 4
+            data = run["data"]
+            if data is None or len(data) < start + sum(sizes):
+                # the file has grown since it was mapped
+                data = run["data"] = np.memmap(os.path.join(directory, "data.f32"), dtype = np.float32, mode = "r")
+        cube = data[start:start + sizes[0]].reshape(cubeShape)
+        start += sizes[0]
+        quantiles = data[start:start + sizes[1]].reshape(quantileShape)
+        start += sizes[1]
+        probabilities = data[start:start + sizes[2]].reshape(probabilityShape)
+        dates = np.datetime64(entry["time"], "s") + np.arange(cubeShape[2]) * np.timedelta64(entry["interval"], "s")
+        return {"dates": dates,
+                "cube": cube,
+                "quantiles": quantiles,
+                "probabilities": probabilities,
+                "variables": entry["variables"],
+                "utcOffsetSeconds": entry["utcOffsetSeconds"]}
+
+    def put(self, cell, modelRun, ensemble):
+        with self.lock:
+            directory, _ = self.getRun(modelRun)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok = True)
+            self.collectGarbage()
+        cube = np.ascontiguousarray(ensemble["cube"], dtype = np.float32)
+        quantiles, probabilities = calculate_quantiles(
+            cube, thresholds = [EXCEEDANCE_THRESHOLDS.get(variable) for variable in ensemble["variables"]])
+        dates = ensemble["dates"].astype('datetime64[s]')
+        with open(os.path.join(directory, "index.jsonl"), "ab") as indexFile:
+            fcntl.flock(indexFile, fcntl.LOCK_EX)
+            try:
+                with open(os.path.join(directory, "data.f32"), "ab") as dataFile:
+                    offset = dataFile.tell()
+                    for array in (cube, quantiles, probabilities):
+                        dataFile.write(np.ascontiguousarray(array, dtype = np.float32).tobytes())
+                entry = {"cell": list(cell),
+                         "offset": offset,
+                         "cube": list(cube.shape),
+                         "quantiles": list(quantiles.shape),
+                         "time": int(dates[0].astype(np.int64)),
+                         "interval": int((dates[1] - dates[0]) / np.timedelta64(1, 's')) if len(dates) > 1 else 3600,
+                         "variables": list(ensemble["variables"]),
+                         "utcOffsetSeconds": int(ensemble["utcOffsetSeconds"])}
+                indexFile.write(json.dumps(entry).encode("utf-8") + b"\n")
+            finally:
+                fcntl.flock(indexFile, fcntl.LOCK_UN)
+
+    def collectGarbage(self):
+        # delete all but the newest keepRuns runs, readers that still map them keep their data
+        runs = sorted(name for name in os.listdir(self.path) if name.isdigit())
+        for name in runs[:-self.keepRuns]:
+            shutil.rmtree(os.path.join(self.path, name), ignore_errors = True)
+
+_forecastStore = None
+
+def getForecastStore():
+    global _forecastStore
+    if not FORECAST_STORE_PATH:
+        return None
+    if _forecastStore is None:
+        _forecastStore = ForecastStore(FORECAST_STORE_PATH, FORECAST_STORE_RUNS)
+    return _forecastStore
+
+# geocoding: offline gazetteer first, then the persistent cache, then Nominatim
+GEOCODE_CACHE_PATH = os.path.join(DATA_PATH, "geocode.sqlite")
+GEOCODE_CACHE_TTL = 90 * 24 * 3600  # seconds
+GEOCODE_CACHE_SIZE = 100000
+# sorted "name<TAB>latitude<TAB>longitude" lines, see buildGazetteer
+GAZETTEER_PATH = os.path.join(DATA_PATH, "gazetteer.tsv")
+
+def configure(config):
+    # take over the settings of this module from a dict like object (e.g. the flask config)
+    module = sys.modules[__name__]
+    for key, value in config.items():
+        if key.isupper() and hasattr(module, key):
+            setattr(module, key, value)
+
+def normalizeQuery(query):
+    # "  Braunschweig,Germany " and "braunschweig germany" are the same place
+    query = unicodedata.normalize("NFKC", query).casefold()
+    query = re.sub(r"[,;\t]", " ", query)
+    return " ".join(query.split())
+
+class Gazetteer:
+    # place name index, binary searched in a memory mapped file
+    def __init__(self, path):
+        self.fp = open(path, "rb")
+        self.data = mmap.mmap(self.fp.fileno(), 0, access = mmap.ACCESS_READ)
+
+    def lookup(self, query):
+        key = normalizeQuery(query).encode("utf-8") + b"\t"
+        data = self.data
+        lo, hi = 0, len(data)
+        # find the first line that is not smaller than key
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = data.rfind(b"\n", 0, mid) + 1
+            end = data.find(b"\n", start)
+            if end < 0:
+                end = len(data)
+            if data[start:end + 1] < key:
+                lo = end + 1
+            else:
+                hi = start
+        if not data[lo:lo + len(key)] == key:
+            return None
+        end = data.find(b"\n", lo)
+        _, latitude, longitude = data[lo:end if end >= 0 else len(data)].split(b"\t")
+        return float(latitude), float(longitude)
+
+def buildGazetteer(citiesFile, outFile = GAZETTEER_PATH, countryInfoFile = None):
+    # build the gazetteer from a GeoNames cities dump (e.g. cities15000.txt), each place is
+    # reachable by its name and its name followed by the country code or country name.
+    # For names used more than once the place with the most inhabitants wins.
+    countries = {}
+    if countryInfoFile:
+        with open(countryInfoFile, encoding = "utf-8") as fp:
+            for line in fp:
+                if not line.startswith("#"):
+                    fields = line.rstrip("\n").split("\t")
+                    countries[fields[0]] = fields[4]
+    places = {}
+    with open(citiesFile, encoding = "utf-8") as fp:
+        for line in fp:
+            fields = line.rstrip("\n").split("\t")
+            names = {fields[1], fields[2]}
+            latitude, longitude, countryCode = float(fields[4]), float(fields[5]), fields[8]
+            population = int(fields[14] or 0)
+            for name in names:
+                for key in [name, name + " " + countryCode, name + " " + countries.get(countryCode, countryCode)]:
+                    key = normalizeQuery(key)
+                    if key and (key not in places or places[key][0] < population):
+                        places[key] = (population, latitude, longitude)
+    lines = sorted((key.encode("utf-8") + b"\t" + f"{latitude}\t{longitude}".encode() + b"\n")
+                   for key, (_, latitude, longitude) in places.items())
+    os.makedirs(os.path.dirname(os.path.abspath(outFile)), exist_ok = True)
+    with open(outFile, "wb") as fp:
+        fp.writelines(lines)
+
+class GeocodeCache:
+    # persistent query -> coordinates cache with a time to live and LRU eviction
+    def __init__(self, path, ttl, maxEntries):
+        self.path = path
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok = True)
+            self.connection = sqlite3.connect(self.path, check_same_thread = False)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS geocode (query TEXT PRIMARY KEY, "
+                                    "latitude REAL, longitude REAL, created REAL, accessed REAL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS geocode_accessed ON geocode (accessed)")
+        return self.connection
+
+    def get(self, query):
+        now = time.time()
+        with self.lock:
+            connection = self.connect()
+            row = connection.execute("SELECT latitude, longitude, created FROM geocode WHERE query = ?",
+                                     (query,)).fetchone()
+            if row is None:
+                return None
+            if row[2] < now - self.ttl:
+                connection.execute("DELETE FROM geocode WHERE query = ?", (query,))
+                connection.commit()
+                return None
+            connection.execute("UPDATE geocode SET accessed = ? WHERE query = ?", (now, query))
+            connection.commit()
+            return row[0], row[1]
+
+    def put(self, query, latitude, longitude):
+        now = time.time()
+        with self.lock:
+            connection = self.connect()
+            connection.execute("INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?, ?)",
+                               (query, latitude, longitude, now, now))
+            connection.execute("DELETE FROM geocode WHERE created < ?", (now - self.ttl,))
+            connection.execute("DELETE FROM geocode WHERE query IN (SELECT query FROM geocode "
+                               "ORDER BY accessed DESC LIMIT -1 OFFSET ?)", (self.maxEntries,))
+            connection.commit()
+
+_gazetteer = None
+_geocodeCache = None
+_geolocator = None
+_geocodeLock = threading.Lock()
+
+def loadGeocoders():
+    # the gazetteer is mapped and Nominatim set up on first use, the cache connects on its first query
+    global _gazetteer, _geocodeCache, _geolocator
+    with _geocodeLock:
+        if _gazetteer is None and GAZETTEER_PATH and os.path.exists(GAZETTEER_PATH):
+            _gazetteer = Gazetteer(GAZETTEER_PATH)
+        if _geocodeCache is None:
+            _geocodeCache = GeocodeCache(GEOCODE_CACHE_PATH, GEOCODE_CACHE_TTL, GEOCODE_CACHE_SIZE)
+        if _geolocator is None:
+            from geopy.geocoders import Nominatim
+            _geolocator = Nominatim(user_agent="ESOWC-Meteogram-2018")
+
+@metrics.stage("geocode")
+def geocode(query):
+    loadGeocoders()
+    key = normalizeQuery(query)
+    if _gazetteer is not None:
+        coordinates = _gazetteer.lookup(key)
+        metrics.countCache("gazetteer", coordinates is not None)
+        if coordinates is not None:
+            return coordinates
+    coordinates = _geocodeCache.get(key)
+    metrics.countCache("geocode", coordinates is not None)
+    if coordinates is not None:
+        return coordinates
+    with metrics.stage("nominatim"):
+        loc = _geolocator.geocode(query)
+    if loc is None:
+        raise ValueError(f"location {query!r} not found")
+    _geocodeCache.put(key, loc.latitude, loc.longitude)
+    return loc.latitude, loc.longitude
+
+# elevation: "dem" reads local SRTM .hgt tiles (e.g. N52E010.hgt) from DEM_PATH,
+# "open-elevation" asks api.open-elevation.com, which is also the fallback for missing tiles
+ELEVATION_PROVIDER = "dem"
+ELEVATION_HTTP_FALLBACK = True
+ELEVATION_TIMEOUT = 5  # seconds
+DEM_PATH = "dem/"
+DEM_TILE_CACHE_SIZE = 16
+
+class DemElevation:
+    # elevation from memory mapped 1°x1° SRTM tiles, bilinear interpolated
+    VOID = -32768
+
+    def __init__(self, path, maxTiles = 16):
+        self.path = path
+        self.maxTiles = maxTiles
+        self.tiles = OrderedDict()  # tile name -> memmap, None if there is no such tile
+        self.lock = threading.Lock()
+
+    def getTile(self, name):
+        with self.lock:
+            if name in self.tiles:
+                self.tiles.move_to_end(name)
+                return self.tiles[name]
+            filename = os.path.join(self.path, name)
+            tile = None
+            if os.path.exists(filename):
+                size = int(round(np.sqrt(os.path.getsize(filename) / 2)))
+                tile = np.memmap(filename, dtype = ">i2", mode = "r", shape = (size, size))
+            self.tiles[name] = tile
+            while len(self.tiles) > self.maxTiles:
+                self.tiles.popitem(last = False)
+            return tile
+
+    def lookup(self, latitude, longitude):
+        south = int(np.floor(latitude))
+        west = int(np.floor(longitude))
+        name = "%s%02d%s%03d.hgt" % ("N" if south >= 0 else "S", abs(south),
+                                     "E" if west >= 0 else "W", abs(west))
+        tile = self.getTile(name)
+        if tile is None:
+            return None
+        size = tile.shape[0]
+        # the first row is the northern edge of the tile
+        y = (south + 1 - latitude) * (size - 1)
+        x = (longitude - west) * (size - 1)
+        row = min(int(y), size - 2)
+        col = min(int(x), size - 2)
+        corners = tile[row:row + 2, col:col + 2].astype(float)
+        if (corners == self.VOID).any():
+            return None
+        dy = y - row
+        dx = x - col
+        top = corners[0, 0] * (1 - dx) + corners[0, 1] * dx
+        bottom = corners[1, 0] * (1 - dx) + corners[1, 1] * dx
+        return top * (1 - dy) + bottom * dy
+
+_demElevation = None
+_elevationSession = None
+
+def getOpenElevation(latitude, longitude):
+    global _elevationSession
+    import requests
+    if _elevationSession is None:
+        _elevationSession = requests.Session()
+        _elevationSession.hooks["response"].append(metrics.countUpstream("open-elevation"))
     baseUrl = "https://api.open-elevation.com"
-    response = requests.get(f"{baseUrl}/api/v1/lookup?locations={latitude},{longitute}")
-    result = json.loads(response.text)
+    try:
+        response = _elevationSession.get(f"{baseUrl}/api/v1/lookup?locations={latitude},{longitude}",
+                                         timeout = ELEVATION_TIMEOUT)
+        result = json.loads(response.text)
+    except (requests.RequestException, ValueError):
+        return None
     return(result["results"][0]["elevation"])
 
+@metrics.stage("elevation")
+def getElevation(latitude: int,longitute: int):
+    global _demElevation
+    if ELEVATION_PROVIDER == "dem":
+        if _demElevation is None:
+            _demElevation = DemElevation(DEM_PATH, DEM_TILE_CACHE_SIZE)
+        elevation = _demElevation.lookup(float(latitude), float(longitute))
+        if elevation is not None:
+            return int(round(elevation))
+        if not ELEVATION_HTTP_FALLBACK:
+            return None
+    return getOpenElevation(latitude, longitute)
+
+TIMEZONE_CACHE_SIZE = 100000
+
+class TimezoneResolver:
+    # timezone name per grid cell, the timezone polygons are loaded into memory once
+    def __init__(self, maxEntries = 100000):
+        self.maxEntries = maxEntries
+        self.finder = None
+        self.cells = OrderedDict()  # grid cell -> timezone name
+        self.lock = threading.Lock()
+
+    def loadFinder(self):
+        if self.finder is None:
+            from timezonefinder import TimezoneFinder
+            self.finder = TimezoneFinder(in_memory = True)
+        return self.finder
+
+    def resolve(self, latitude, longitude):
+        cell = getGridCell(latitude, longitude)
+        with self.lock:
+            metrics.countCache("timezone", cell in self.cells)
+            if cell in self.cells:
+                self.cells.move_to_end(cell)
+                return self.cells[cell]
+            self.loadFinder()
+            tzName = self.finder.timezone_at(lat = cell[0], lng = cell[1])
+            if tzName is None or tzName.startswith("Etc/"):
+                # the center of a coastal cell can be at sea, the place itself is not
+                tzName = self.finder.timezone_at(lat = float(latitude), lng = float(longitude)) or tzName
+            self.cells[cell] = tzName
+            while len(self.cells) > self.maxEntries:
+                self.cells.popitem(last = False)
+            return tzName
+
+_timezoneResolver = None
+
+def getTimezoneResolver():
+    global _timezoneResolver
+    if _timezoneResolver is None:
+        _timezoneResolver = TimezoneResolver(TIMEZONE_CACHE_SIZE)
+    return _timezoneResolver
+
+@metrics.stage("timezone")
+def getTimezone(latitude, longitude):
+    return getTimezoneResolver().resolve(latitude, longitude)
+
 def getCoordinates(opts):
     latitude = 0
     longitude = 0
@@ -78,10 +689,7 @@ def getCoordinates(opts):
         elif opt == "--location":
             #print("location", arg)
             location = arg
-            geolocator = Nominatim(user_agent="ESOWC-Meteogram-2018")
-            loc = geolocator.geocode(arg)
-            latitude = loc.latitude
-            longitude = loc.longitude
+            latitude, longitude = geocode(arg)
             print(latitude, longitude)
         elif opt == "--lat":
             latitude = float(arg)
@@ -94,106 +702,331 @@ def getCoordinates(opts):
     return ( latitude, longitude, altitude, location )
 
 
-import openmeteo_requests
-
-from openmeteo_sdk.Variable import Variable
-from openmeteo_sdk.Aggregation import Aggregation
+# the Open-Meteo API client with retry on error, made on first use by getOpenmeteo,
+# responses are cached by ensembleCache
+openmeteo = None
 
-import pandas as pd
-import requests_cache
-from retry_requests import retry
+def getOpenmeteo():
+    global openmeteo
+    if openmeteo is None:
+        import requests
+        import openmeteo_requests
+        from retry_requests import retry
+        retry_session = retry(requests.Session(), retries = 5, backoff_factor = 0.2)
+        retry_session.hooks["response"].append(metrics.countUpstream("open-meteo"))
+        openmeteo = openmeteo_requests.Client(session = retry_session)
+    return openmeteo
 
-# Setup the Open-Meteo API client with cache and retry on error
-cache_session = requests_cache.CachedSession('.cache', expire_after = 3600)
-retry_session = retry(cache_session, retries = 5, backoff_factor = 0.2)
-openmeteo = openmeteo_requests.Client(session = retry_session)
+# parsed ensembles per grid cell of the current model run
+ensembleCache = ModelRunCache(maxEntries = 128, name = "ensemble")
 
 # Make sure all required weather variables are listed here
-# The order of variables in hourly or daily is important to assign them correctly below
 url = "https://ensemble-api.open-meteo.com/v1/ensemble"
-def getData(longitude, latitude, altitude, writeToFile = True, meteogram = "10days"):
-    params = {
-        "latitude": latitude,
-        "longitude": longitude,
-        "hourly": ["temperature_2m", "precipitation", "wind_speed_10m", "cloud_cover"],
-        "models": "ecmwf_ifs025",
-        "timezone": "auto",
-        "forecast_days": 14
-    }
-    responses = openmeteo.weather_api(url, params=params)
+# seconds the connection to open-meteo and every read of the answer may take, a hung
+# request fails instead of blocking its cells for every later request
+ENSEMBLE_TIMEOUT = 30
+# seconds a call waits for the download of a cell that another call started
+ENSEMBLE_WAIT_TIMEOUT = 60
+ENSEMBLE_VARIABLES = ["temperature_2m", "precipitation", "cloud_cover", "wind_speed_10m"]
 
-    # Process first location. Add a for-loop for multiple locations or weather models
-    response = responses[0]
-    print(f"Coordinates {response.Latitude()}°N {response.Longitude()}°E")
-    print(f"Elevation {response.Elevation()} m asl")
-    print(f"Timezone {response.Timezone()}{response.TimezoneAbbreviation()}")
-    print(f"Timezone difference to GMT+0 {response.UtcOffsetSeconds()} s")
+# open-meteo variable name and altitude (None if it has none) of every ensemble variable
+ENSEMBLE_VARIABLE_CODES = {"temperature_2m": ("temperature", 2),
+                           "precipitation": ("precipitation", None),
+                           "cloud_cover": ("cloud_cover", None),
+                           "wind_speed_10m": ("wind_speed", 10)}
 
-    # Process hourly data
+@metrics.stage("parse")
+def parseEnsemble(response, variables = ENSEMBLE_VARIABLES):
+    # the hourly members of the response as one float32 (variable, member, time) cube.
+    # The variables are walked once and every member is copied straight from the
+    # flatbuffer into its row, members that are missing stay NaN.
+    from openmeteo_sdk.Variable import Variable
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("ensemble latitude=%s longitude=%s elevation=%s timezone=%s utcOffset=%s",
+                  response.Latitude(), response.Longitude(), response.Elevation(),
+                  response.Timezone(), response.UtcOffsetSeconds())
     hourly = response.Hourly()
-    hourly_variables = list(map(lambda i: hourly.Variables(i), range(0, hourly.VariablesLength())))
-    hourly_temperature_2m = filter(lambda x: x.Variable() == Variable.temperature and x.Altitude() == 2, hourly_variables)
-    hourly_precipitation = filter(lambda x: x.Variable() == Variable.precipitation, hourly_variables)
-    hourly_wind_speed_10m = filter(lambda x: x.Variable() == Variable.wind_speed and x.Altitude() == 10, hourly_variables)
-    hourly_cloud_cover = filter(lambda x: x.Variable() == Variable.cloud_cover, hourly_variables)
-
-    hourly_data = {"date": pd.date_range(
-        start = pd.to_datetime(hourly.Time(), unit = "s", utc = True),
-        end = pd.to_datetime(hourly.TimeEnd(), unit = "s", utc = True),
-        freq = pd.Timedelta(seconds = hourly.Interval()),
-        inclusive = "left"
-    )}
-
-    # Process all members
-    for variable in hourly_temperature_2m:
-        member = variable.EnsembleMember()
-        hourly_data[f"temperature_2m_member{member}"] = variable.ValuesAsNumpy()
-    for variable in hourly_precipitation:
+    interval = hourly.Interval()
+    nSteps = (hourly.TimeEnd() - hourly.Time()) // interval
+    rows = {}  # (open-meteo variable, altitude or None) -> row of the cube
+    for i, name in enumerate(variables):
+        code, altitude = ENSEMBLE_VARIABLE_CODES[name]
+        rows[(getattr(Variable, code), altitude)] = i
+    cube = np.full((len(variables), ENSEMBLE_MEMBERS, nSteps), np.nan, dtype = np.float32)
+    for i in range(hourly.VariablesLength()):
+        variable = hourly.Variables(i)
+        code = variable.Variable()
+        row = rows.get((code, variable.Altitude()), rows.get((code, None)))
         member = variable.EnsembleMember()
-        hourly_data[f"precipitation_member{member}"] = variable.ValuesAsNumpy()
-    for variable in hourly_wind_speed_10m:
-        member = variable.EnsembleMember()
-        hourly_data[f"wind_speed_10m_member{member}"] = variable.ValuesAsNumpy()
-    for variable in hourly_cloud_cover:
-        member = variable.EnsembleMember()
-        hourly_data[f"cloud_cover_member{member}"] = variable.ValuesAsNumpy()
-
-    hourly_dataframe = pd.DataFrame(data = hourly_data)
-    allMeteogramData = {"2t": create_dictionary(
-        calculate_percentiles(
-            hourly_dataframe,
-            column_string="temperature_2m"),
-        "2t",
-        step_interval=6
-    ),
-    "tp": create_dictionary(
-        calculate_percentiles(
-            hourly_dataframe,
-            column_string="precipitation"),
-        "tp",
-        step_interval=6
-    ),
-    "tcc": create_dictionary(
-        calculate_percentiles(
-            hourly_dataframe,
-            column_string="cloud_cover"),
-        "tcc",
-        step_interval=6
-    ),
-    "ws": create_dictionary(
-        calculate_percentiles(
-            hourly_dataframe,
-            column_string="wind_speed_10m"),
-        "ws",
-        step_interval=6
-    )
+        if row is not None and member < ENSEMBLE_MEMBERS:
+            cube[row, member] = variable.ValuesAsNumpy()
+    dates = np.datetime64(hourly.Time(), 's') + np.arange(nSteps) * np.timedelta64(interval, 's')
+    # the arrays are shared by all requests for this grid cell
+    cube.flags.writeable = False
+    dates.flags.writeable = False
+    return {"dates": dates,
+            "cube": cube,
+            "variables": list(variables),
+            "utcOffsetSeconds": response.UtcOffsetSeconds()}
+
+# Open-Meteo answers several coordinates in one request, one response per location
+MAX_LOCATIONS_PER_REQUEST = 100
+# forecast days requested from open-meteo, a meteogram gets the shortest of them that
+# covers it, so meteograms of similar length share downloads. Longer downloads answer
+# shorter meteograms from the caches.
+FORECAST_DAYS = [4, 8, 11, 14, 16]
+
+def getForecastDays(days = None):
+    # the hourly data starts at local midnight, a meteogram of days days from now ends
+    # before the end of day days + 1. Without days the longest forecast.
+    if days is not None:
+        for forecastDays in FORECAST_DAYS:
+            if forecastDays >= days + 1:
+                return forecastDays
+    return FORECAST_DAYS[-1]
+
+def getEnsembleDays(ensemble):
+    dates = ensemble["dates"]
+    if len(dates) < 2:
+        return 0
+    return len(dates) * int((dates[1] - dates[0]) / np.timedelta64(1, 's')) // 86400
+
+def trimEnsemble(ensemble, forecastDays):
+    # the first forecastDays days of an ensemble as views of its arrays, so a meteogram
+    # does not depend on which download answered it
+    if getEnsembleDays(ensemble) <= forecastDays:
+        return ensemble
+    dates = ensemble["dates"]
+    nSteps = forecastDays * 86400 // int((dates[1] - dates[0]) / np.timedelta64(1, 's'))
+    trimmed = dict(ensemble)
+    trimmed["dates"] = dates[:nSteps]
+    trimmed["cube"] = ensemble["cube"][:, :, :nSteps]
+    if "quantiles" in ensemble:
+        trimmed["quantiles"] = ensemble["quantiles"][:, :, :nSteps]
+        trimmed["probabilities"] = ensemble["probabilities"][:, :nSteps]
+    return trimmed
+
+def getEnsembleParams(cells, forecastDays = None):
+    # request parameters for the ensembles of the grid cells
+    return {
+        "latitude": [cell[0] for cell in cells],
+        "longitude": [cell[1] for cell in cells],
+        "hourly": ENSEMBLE_VARIABLES,
+        "models": "ecmwf_ifs025",
+        "timezone": "auto",
+        "forecast_days": forecastDays if forecastDays is not None else FORECAST_DAYS[-1]
     }
+
+# downloads in flight per (grid cell, model run, forecast days), shared by all threads
+ensembleDownloads = SingleFlight("download")
+
+def fetchEnsembles(coordinates, forecastDays = None):
+    # coordinates is a list of (latitude, longitude), returns one ensemble of forecastDays
+    # days per coordinate. Points in the same grid cell share one parse, cells that are
+    # not cached with at least forecastDays days yet are requested together in as few
+    # requests as possible. Cells another thread is downloading right now are waited
+    # for instead of requested again.
+    if forecastDays is None:
+        forecastDays = FORECAST_DAYS[-1]
+    covers = lambda ensemble: getEnsembleDays(ensemble) >= forecastDays
+    modelRun = getModelRun()
+
+    def cacheEnsemble(cell, ensemble):
+        # a longer ensemble another thread cached meanwhile is kept
+        days = getEnsembleDays(ensemble)
+        ensembleCache.put(cell, modelRun, ensemble, replace = lambda cached: getEnsembleDays(cached) < days)
+
+    cells = [getGridCell(latitude, longitude) for latitude, longitude in coordinates]
+    ensembles = {}
+    missing = {}  # cell -> future this call has to resolve
+    waiting = {}  # cell -> future of another thread's download
+    store = getForecastStore()
+    try:
+        for cell in cells:
+            if cell in ensembles or cell in missing or cell in waiting:
+                continue
+            ensemble = ensembleCache.get(cell, modelRun, accept = covers)
+            if ensemble is not None:
+                ensembles[cell] = ensemble
+                continue
+            future, leader = ensembleDownloads.begin((cell, modelRun, forecastDays))
+            if not leader:
+                waiting[cell] = future
+                continue
+            if store is not None:
+                # downloaded by another process or before a restart
+                ensemble = store.get(cell, modelRun, forecastDays)
+                metrics.countCache("store", ensemble is not None)
+            if ensemble is None:
+                missing[cell] = future
+                continue
+            cacheEnsemble(cell, ensemble)
+            ensembles[cell] = ensemble
+            ensembleDownloads.finish((cell, modelRun, forecastDays), future, ensemble)
+        batches = list(missing)
+        for first in range(0, len(batches), MAX_LOCATIONS_PER_REQUEST):
+            batch = batches[first:first + MAX_LOCATIONS_PER_REQUEST]
+            with metrics.stage("download"):
+                responses = getOpenmeteo().weather_api(url, params=getEnsembleParams(batch, forecastDays), method="POST" if len(batch) > 1 else "GET",
+                                                       timeout=ENSEMBLE_TIMEOUT)
+            if len(responses) != len(batch):
+                raise ValueError(f"expected {len(batch)} locations from open-meteo, got {len(responses)}")
+            for cell, response in zip(batch, responses):
+                ensemble = parseEnsemble(response)
+                if store is not None:
+                    store.put(cell, modelRun, ensemble)
+                    ensemble = store.get(cell, modelRun)
+                cacheEnsemble(cell, ensemble)
+                ensembles[cell] = ensemble
+                ensembleDownloads.finish((cell, modelRun, forecastDays), missing.pop(cell), ensemble)
+    except BaseException as e:
+        # the threads waiting for the cells of this call get its exception
+        for cell, future in missing.items():
+            ensembleDownloads.finish((cell, modelRun, forecastDays), future, exception = e)
+        raise
+    for cell, future in waiting.items():
+        try:
+            ensembles[cell] = future.result(timeout = ENSEMBLE_WAIT_TIMEOUT)
+        except TimeoutError:
+            raise TimeoutError(f"the download of grid cell {cell} took longer than {ENSEMBLE_WAIT_TIMEOUT} seconds")
+    return [trimEnsemble(ensembles[cell], forecastDays) for cell in cells]
+
+def fetchEnsemble(longitude, latitude, forecastDays = None):
+    # all points in one grid cell share the upstream request and the parsed arrays
+    return fetchEnsembles([(latitude, longitude)], forecastDays)[0]
+
+# daily meteogram: name, ensemble variable and how the hours of a day are aggregated per member
+DAILY_VARIABLES = [("tp24", "precipitation", np.sum),
+                   ("mn2t24", "temperature_2m", np.min),
+                   ("mx2t24", "temperature_2m", np.max),
+                   ("tcc24", "cloud_cover", np.mean),
+                   ("ws24", "wind_speed_10m", np.max)]
+
+def getLocalOffsets(dates, tzName = None, utcOffsetSeconds = 0):
+    # utc offset (timedelta64[s]) of the timezone tzName at every utc time of dates, the
+    # fixed offset utcOffsetSeconds if the timezone is unknown
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+    try:
+        tz = ZoneInfo(tzName) if tzName else None
+    except (ZoneInfoNotFoundError, ValueError):
+        log.warning("unknown timezone %r, using the utc offset %ss", tzName, utcOffsetSeconds)
+        tz = None
+    if tz is None:
+        return np.full(len(dates), utcOffsetSeconds, dtype = 'timedelta64[s]')
+    return np.array([datetime.fromtimestamp(int(time), tz).utcoffset() for time in dates.astype(np.int64)],
+                    dtype = 'timedelta64[s]')
+
+@functools.lru_cache(maxsize = 256)
+def getLocalDayStarts(tzName, start, steps, interval, utcOffsetSeconds):
+    # index of the first step of every complete local day of the time axis start (utc
+    # seconds), steps steps of interval seconds, and the first local day. The axis is the
+    # same for all places of a model run, so it is computed once per timezone.
+    # The local dates of one step before and after the axis tell whether the first and the
+    # last day are complete.
+    times = np.datetime64(start, 's') + np.arange(-1, steps + 1) * np.timedelta64(interval, 's')
+    localDays = (times + getLocalOffsets(times, tzName, utcOffsetSeconds)).astype('datetime64[D]')
+    starts = np.flatnonzero(localDays[1:] != localDays[:-1])
+    starts.flags.writeable = False
+    firstDay = localDays[starts[0] + 1] if len(starts) else localDays[1]
+    return starts, firstDay
+
+def aggregateDaily(ensemble, tzName = None):
+    # the complete local days of the ensemble as a (daily variable, member, day) cube and the
+    # first local day. The hours are grouped by their local date in the timezone tzName, the
+    # offset changes with daylight saving time, so a day has 23, 24 or 25 hours. Without a
+    # timezone the utc offset open-meteo reports is used. A day is labelled with its start
+    # like open-meteo's daily values.
+    cube = ensemble["cube"]
+    dates = ensemble["dates"].astype('datetime64[s]')
+    starts, firstDay = getLocalDayStarts(tzName, int(dates[0].astype(np.int64)), len(dates),
+                                         int((dates[1] - dates[0]) / np.timedelta64(1, 's')),
+                                         int(ensemble["utcOffsetSeconds"]))
+    nDays = max(len(starts) - 1, 0)
+    lengths = np.diff(starts)
+    daily = np.empty((len(DAILY_VARIABLES), cube.shape[1], nDays), dtype = np.float32)
+    for i, (name, column_string, aggregate) in enumerate(DAILY_VARIABLES):
+        hours = cube[ensemble["variables"].index(column_string)]
+        if nDays and (lengths == lengths[0]).all():
+            # no change of the utc offset, the days are a reshape
+            daily[i] = aggregate(hours[:, starts[0]:starts[-1]].reshape(hours.shape[0], nDays, lengths[0]), axis = -1)
+            continue
+        for day in range(nDays):
+            daily[i, :, day] = aggregate(hours[:, starts[day]:starts[day + 1]], axis = -1)
+    return daily, firstDay
+
+def getDailyMeteogramData(ensemble, tzName = None):
+    # the 15days meteogram, percentiles of the daily values of the members. Step i is the
+    # end of day i, like the 24 hour accumulations of the ecmwf daily products.
+    daily, firstDay = aggregateDaily(ensemble, tzName)
+    quantiles, probabilities = calculate_quantiles(
+        daily, thresholds=[EXCEEDANCE_THRESHOLDS.get(column_string) for _, column_string, _ in DAILY_VARIABLES])
+    days = firstDay + np.arange(daily.shape[2]) * np.timedelta64(1, 'D')
+    allMeteogramData = {}
+    for i, (name, column_string, _) in enumerate(DAILY_VARIABLES):
+        allMeteogramData[name] = create_quantile_dictionary(
+            quantiles[i],
+            days,
+            name,
+            probabilities=probabilities[i] if column_string in EXCEEDANCE_THRESHOLDS else None)
+        allMeteogramData[name][name]["steps"] = [str(24 * (step + 1)) for step in range(daily.shape[2])]
+    return allMeteogramData
+
+@metrics.stage("quantiles")
+def getMeteogramData(ensemble, meteogram = "10days", tzName = None):
+    # tzName is the timezone whose local days the 15days meteogram aggregates
+    if meteogram == "15days":
+        return getDailyMeteogramData(ensemble, tzName)
+    cube = ensemble["cube"]
+
+    # The percentiles of all variables are computed in one go
+    variables = [("2t", "temperature_2m"), ("tp", "precipitation"), ("tcc", "cloud_cover"), ("ws", "wind_speed_10m")]
+    step_interval = 6
+    if "quantiles" in ensemble:
+        # precomputed by the forecast store for every hour
+        quantiles = ensemble["quantiles"][:, :, ::step_interval]
+        probabilities = ensemble["probabilities"][:, ::step_interval]
+    else:
+        quantiles, probabilities = calculate_quantiles(
+            cube[:, :, ::step_interval],
+            thresholds=[EXCEEDANCE_THRESHOLDS.get(column_string) for column_string in ensemble["variables"]])
+    dates = ensemble["dates"]
+    allMeteogramData = {}
+    for name, column_string in variables:
+        i = ensemble["variables"].index(column_string)
+        allMeteogramData[name] = create_quantile_dictionary(
+            quantiles[i],
+            dates[::step_interval],
+            name,
+            probabilities=probabilities[i] if column_string in EXCEEDANCE_THRESHOLDS else None)
+    return allMeteogramData
+
+def getData(longitude, latitude, altitude, writeToFile = True, meteogram = "10days", days = None, tzName = None):
+    # only the forecast days a meteogram of days days needs are downloaded
+    allMeteogramData = getMeteogramData(fetchEnsemble(longitude, latitude, getForecastDays(days)), meteogram, tzName)
     if writeToFile:
         with open("allmeteogramdata.json", "w") as fp:
             json.dump(allMeteogramData, fp)
     return allMeteogramData
 
+def getDataBatch(coordinates, meteogram = "10days", days = None):
+    # allMeteogramData for every (latitude, longitude) in coordinates, e.g. to pre-warm or export stations
+    return [getMeteogramData(ensemble, meteogram) for ensemble in fetchEnsembles(coordinates, getForecastDays(days))]
+
+def preload():
+    # imports everything the functions above import lazily and loads the gazetteer and the
+    # timezone polygons, e.g. once in a parent process that forks workers afterwards.
+    # It opens no connections and starts no threads.
+    from openmeteo_sdk.Variable import Variable
+    loadGeocoders()
+    getOpenmeteo()
+    with getTimezoneResolver().lock:
+        getTimezoneResolver().loadFinder()
+
 if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == "--build-gazetteer":
+        # downloadJsonData.py --build-gazetteer cities15000.txt [gazetteer.tsv [countryInfo.txt]]
+        buildGazetteer(*sys.argv[2:5])
+        sys.exit(0)
     latitude = 0
     longitude = 0
     altitude = -999
@@ -207,6 +1040,7 @@ if __name__ == '__main__':
             print("downloadJsonData.py --lat 20 --lon 10")
             sys.exit(2)
     else:
+        from geopy.geocoders import Nominatim
         location = "Braunschweig Germany"
         geolocator = Nominatim(user_agent="ESOWC-Meteogram-2018")
         loc = geolocator.geocode(location)
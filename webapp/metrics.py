@@ -0,0 +1,175 @@
+import threading
+import time
+import bisect
+import logging
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+#upper bounds (seconds) of the latency histogram buckets, +Inf is added
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def formatLabels(labelNames, labels, extra = ()):
+    pairs = list(zip(labelNames, labels)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                           for name, value in pairs) + "}"
+
+def formatValue(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class Counter:
+    #monotonic count per combination of label values
+    type = "counter"
+
+    def __init__(self, name, help, labelNames = ()):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.values = {}#label values -> count
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        return self.values.get(labels, 0)
+
+    def lines(self):
+        with self.lock:
+            return ["%s%s %s" % (self.name, formatLabels(self.labelNames, labels), formatValue(value))
+                    for labels, value in sorted(self.values.items())]
+
+    def drain(self):
+        with self.lock:
+            values, self.values = self.values, {}
+        return values
+
+    def merge(self, values):
+        with self.lock:
+            for labels, value in values.items():
+                self.values[labels] = self.values.get(labels, 0) + value
+
+class Histogram:
+    #distribution of observed values per combination of label values
+    type = "histogram"
+
+    def __init__(self, name, help, labelNames = (), buckets = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.buckets = tuple(buckets)
+        self.values = {}#label values -> [counts per bucket (not cumulative), sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    def lines(self):
+        lines = []
+        with self.lock:
+            for labels, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    lines.append("%s_bucket%s %d" % (self.name, formatLabels(self.labelNames, labels, [("le", formatValue(bound))]), cumulative))
+                lines.append("%s_sum%s %s" % (self.name, formatLabels(self.labelNames, labels), repr(total)))
+                lines.append("%s_count%s %d" % (self.name, formatLabels(self.labelNames, labels), cumulative))
+        return lines
+
+    def drain(self):
+        with self.lock:
+            values, self.values = self.values, {}
+        return values
+
+    def merge(self, values):
+        with self.lock:
+            for labels, (counts, total) in values.items():
+                state = self.values.get(labels)
+                if state is None:
+                    state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+                state[0] = [a + b for a, b in zip(state[0], counts)]
+                state[1] += total
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}#name -> Counter or Histogram
+
+    def add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        #all metrics in the Prometheus text exposition format
+        lines = []
+        for metric in self.metrics.values():
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type))
+            lines.extend(metric.lines())
+        return "\n".join(lines) + "\n"
+
+    def drain(self):
+        #everything recorded since the last drain, reset afterwards, to be merged into
+        #the registry of another process
+        return {name: metric.drain() for name, metric in self.metrics.items()}
+
+    def merge(self, snapshot):
+        for name, values in snapshot.items():
+            if name in self.metrics:
+                self.metrics[name].merge(values)
+
+registry = Registry()
+
+STAGE_SECONDS = registry.add(Histogram("meteogram_stage_seconds",
+    "Seconds spent per stage of making a meteogram", ("stage",)))
+STAGE_ERRORS = registry.add(Counter("meteogram_stage_errors_total",
+    "Stages that raised an exception", ("stage",)))
+CACHE_REQUESTS = registry.add(Counter("meteogram_cache_requests_total",
+    "Cache lookups by cache and result (hit or miss)", ("cache", "result")))
+STAGE_TIMEOUTS = registry.add(Counter("meteogram_stage_timeouts_total",
+    "Requests that stopped waiting for a stage and used its fallback", ("stage",)))
+REQUEST_SECONDS = registry.add(Histogram("meteogram_http_request_seconds",
+    "Seconds to answer http requests", ("endpoint", "status")))
+COALESCED = registry.add(Counter("meteogram_coalesced_total",
+    "Calls that waited for an identical computation in flight instead of starting their own", ("flight",)))
+UPSTREAM_BYTES = registry.add(Counter("meteogram_upstream_bytes_total",
+    "Bytes received from upstream services", ("upstream",)))
+UPSTREAM_REQUESTS = registry.add(Counter("meteogram_upstream_requests_total",
+    "Requests to upstream services by http status", ("upstream", "status")))
+
+@contextmanager
+def stage(name):
+    #times the block (or the decorated function) as the given stage, exceptions are
+    #counted as errors of the stage and passed on
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.inc(name)
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        STAGE_SECONDS.observe(seconds, name)
+        log.debug("stage=%s seconds=%.4f", name, seconds)
+
+def countCache(cache, hit):
+    CACHE_REQUESTS.inc(cache, "hit" if hit else "miss")
+
+def countUpstream(upstream):
+    #requests response hook counting the status and received bytes of a session
+    def hook(response, *args, **kwargs):
+        UPSTREAM_REQUESTS.inc(upstream, str(response.status_code))
+        UPSTREAM_BYTES.inc(upstream, amount = len(response.content))
+    return hook
+
+def render():
+    return registry.render()
@@ -1,35 +1,125 @@
 import numpy as np
-import pandas as pd
 from datetime import timedelta, datetime
 import sys, os, json
-import matplotlib
-matplotlib.use('Agg')#use Agg because default is tkinter and its not threadsafe
-from matplotlib import pyplot as plt
-from matplotlib import gridspec
-from matplotlib.ticker import FormatStrFormatter
-from matplotlib.offsetbox import OffsetImage, AnnotationBbox
-from matplotlib.patches import Rectangle
-from matplotlib import offsetbox
-from timezonefinder import TimezoneFinder
+#matplotlib and PIL are imported by the drawing functions, the json api and a web
+#server that renders in worker processes never load them (see preload)
 import pytz
 import getopt
 from pathlib import Path
-import matplotlib.font_manager as fm
+from io import BytesIO
+import threading
+import functools
+import logging
+try:
+    from . import metrics
+except ImportError:
+    import metrics
 
-home = str(Path.home())
+log = logging.getLogger(__name__)
 
-if os.path.exists(home + "/.fonts/BebasNeue Regular.otf"):
-    prop = fm.FontProperties(fname=home+'/.fonts/BebasNeue Regular.otf')
-    prop.set_size(14)
-else:
-    prop = fm.FontProperties(family='DejaVu Sans')
+home = str(Path.home())
 
+@functools.lru_cache(maxsize = None)
+def getPyplot():
+    import matplotlib
+    matplotlib.use('Agg')#use Agg because default is tkinter and its not threadsafe
+    from matplotlib import pyplot
+    return pyplot
 
-if not os.path.exists("output/"):
-    os.mkdir("output")
+@functools.lru_cache(maxsize = None)
+def getFontProperties():
+    #the font of all texts, shared by all renders
+    import matplotlib.font_manager as fm
+    if os.path.exists(home + "/.fonts/BebasNeue Regular.otf"):
+        prop = fm.FontProperties(fname=home+'/.fonts/BebasNeue Regular.otf')
+        prop.set_size(14)
+    else:
+        prop = fm.FontProperties(family='DejaVu Sans')
+    return prop
 
 #print(home)
 
+#dpi the meteograms are saved with, pictograms are resampled for it
+RENDER_DPI = 300
+PICTOGRAM_PATH = './pictogram/'
+PICTOGRAM_DIRS = ['cloud/', 'cloud/enhanced_hres/', 'rain/', 'rain/enhanced_hres/', 'wind/', 'wind/enhanced_hres/']
+
+#pictograms of the symbol rows, indexed by the get*Coordinates classifications
+SYMBOL_PICTOGRAMS = {
+    ("cloud", "enhanced-hres"): ("cloud/enhanced_hres/", ["Stufe1_klarerHimmel.png", "Stufe2_klarerHimmel.png", "Stufe3_klarerHimmel.png", "Stufe4_klarerHimmel.png", "Stufe1_leichtBedeckt.png", "Stufe2_leichtBedeckt.png", "Stufe3_leichtBedeckt.png", "Stufe4_leichtBedeckt.png", "Stufe1_mittlereBewoelkung.png", "Stufe2_mittlereBewoelkung.png", "Stufe3_mittlereBewoelkung.png", "Stufe4_mittlereBewoelkung.png", "Stufe1_starkBewoelkt.png", "Stufe2_starkBewoelkt.png", "Stufe3_starkBewoelkt.png", "Stufe4_starkBewoelkt.png"]),
+    ("cloud", "ensemble"): ("cloud/", ["step1.png", "step2_mostly_clear.png", "step2_mostly_cloudy.png", "step3_sunny.png", "step3_light_clouds.png", "step3_medium_cloudy.png", "step3_cloud_max.png"]),
+    ("rain", "enhanced-hres"): ("rain/enhanced_hres/", ["Stufe1_KeinRegen.png", "Stufe2_KeinRegen.png", "Stufe3_KeinRegen.png", "Stufe4_KeinRegen.png", "Stufe1_leichterRegen.png", "Stufe2_leichterRegen.png", "Stufe3_leichterRegen.png", "Stufe4_leichterRegen.png", "Stufe1_MittlererRegen.png", "Stufe2_MittlererRegen.png", "Stufe3_MittlererRegen.png", "Stufe4_MittlererRegen.png", "Stufe1_Starkregen.png", "Stufe2_Starkregen.png", "Stufe3_Starkregen.png", "Stufe4_Starkregen.png"]),
+    ("rain", "ensemble"): ("rain/", ["step1_v2.png", "Stufe2_KaumRegen.png", "Stufe2_Regen.png", "Stufe3_KeinRegen.png", "Stufe3_leichterRegen.png", "Stufe3_MittlererRegen.png", "Stufe3_Starkregen.png"]),
+    ("wind", "enhanced-hres"): ("wind/enhanced_hres/", ["Stufe1_Windstille.png", "Stufe2_Windstille.png", "Stufe3_Windstille.png", "Stufe4_Windstille.png", "Stufe1_leichterWind.png", "Stufe2_leichterWind.png", "Stufe3_leichterWind.png", "Stufe4_leichterWind.png", "Stufe1_starkerWind.png", "Stufe2_starkerWind.png", "Stufe3_starkerWind.png", "Stufe4_starkerWind.png", "Stufe1_Sturm.png", "Stufe2_Sturm.png", "Stufe3_Sturm.png", "Stufe4_Sturm.png"]),
+    ("wind", "ensemble"): ("wind/", ["step1_v2.png", "Stufe2_kaumWind.png", "Stufe2_vielWind.png", "Stufe3_Windstille.png", "Stufe3_leichterWind.png", "Stufe3_starkerWind.png", "Stufe3_Sturm.png"]),
+}
+
+#process wide pictogram cache, filled once on first use
+_pictograms = {}#path -> decoded RGBA array
+_scaledPictograms = {}#(path, zoom) -> RGBA array resampled to its size at RENDER_DPI
+_pictogramLock = threading.Lock()
+
+def getPictogramZoom(nSteps):
+    #the same zoom is used for all three pictogram rows
+    zoomFactor = 7.72 / nSteps
+    if zoomFactor > 0.45:
+        zoomFactor = 0.45
+    return zoomFactor
+
+def loadPictograms():
+    #decode every pictogram png once
+    from matplotlib.image import imread
+    with _pictogramLock:
+        if _pictograms:
+            return _pictograms
+        for directory in PICTOGRAM_DIRS:
+            path = PICTOGRAM_PATH + directory
+            if not os.path.isdir(path):
+                continue
+            for filename in sorted(os.listdir(path)):
+                if not filename.endswith(".png"):
+                    continue
+                image = imread(path + filename)
+                if image.shape[2] == 3:
+                    image = np.dstack([image, np.ones(image.shape[:2], dtype=image.dtype)])
+                _pictograms[path + filename] = image
+    return _pictograms
+
+def getPictogram(path, zoom):
+    key = (path, zoom)
+    if key in _scaledPictograms:
+        return _scaledPictograms[key]
+    from matplotlib.image import imread
+    from PIL import Image
+    pictograms = loadPictograms()
+    if path in pictograms:
+        image = pictograms[path]
+    else:
+        image = imread(path)
+    scale = zoom * RENDER_DPI / 72
+    size = (max(1, int(round(image.shape[1] * scale))), max(1, int(round(image.shape[0] * scale))))
+    pilImage = Image.fromarray(np.round(image * 255).astype(np.uint8))
+    scaled = np.asarray(pilImage.resize(size, Image.LANCZOS))
+    _scaledPictograms[key] = scaled
+    return scaled
+
+#meteogram lengths (days) whose pictogram sizes are resampled up front, the sizes of
+#other lengths are resampled on first use and kept. 3 days is the default of the form,
+#daily meteograms have at most 15 columns and use the same size.
+WARM_PICTOGRAM_DAYS = [3]
+
+def getPictogramSteps(days):
+    #possible column counts of the symbol rows of a 6 hourly meteogram of days days, the
+    #window starts at the second step of the local day and ends days after now
+    return range(4 * days - 1, 4 * days + 4)
+
+def warmPictogramCache(daysList = WARM_PICTOGRAM_DAYS):
+    #resample all pictograms for the zoom levels of meteograms of the given lengths
+    zooms = set(getPictogramZoom(n) for days in daysList for n in getPictogramSteps(days))
+    for path in loadPictograms():
+        for zoom in zooms:
+            getPictogram(path, zoom)
+
 def getNextDottedHour(hour):
     if hour < 2:
         return 2
@@ -42,26 +132,24 @@ def getNextDottedHour(hour):
     raise ValueError
 
 def getDottedHours(fromDate, toDate):
-    newDate = fromDate + timedelta(hours=0)
-    dottedDates = [newDate]
-    #print(newDate)
-    #print(toDate)
-    while newDate < toDate:
-        newDate = newDate + timedelta(hours=6)
-        dottedDates.append(newDate)
-    return(dottedDates[:-1])
-
+    #every 6 hours from fromDate on, before toDate (datetime64)
+    return np.arange(fromDate, toDate, np.timedelta64(6, 'h'))
 
 def getNumberedHours(fromDate, toDate):
-    newDate = fromDate
-    numberedDates = []
-    while newDate < toDate:
-        if newDate.hour < 12:
-            newDate = datetime(newDate.year, newDate.month, newDate.day, 12,tzinfo=toDate.tzinfo)
-        else:
-            newDate = datetime(newDate.year, newDate.month, newDate.day, 0,tzinfo=toDate.tzinfo) + timedelta(1)
-        numberedDates.append(newDate)
-    return(numberedDates[:-1])
+    #the noons and midnights after fromDate and before toDate (datetime64)
+    day = fromDate.astype('datetime64[D]')
+    first = day + ((fromDate - day) // np.timedelta64(12, 'h') + 1) * np.timedelta64(12, 'h')
+    return np.arange(first, toDate, np.timedelta64(12, 'h'))
+
+def getHours(dates):
+    return ((dates - dates.astype('datetime64[D]')) // np.timedelta64(1, 'h')).astype(int)
+
+def getDays(dates):
+    return (dates.astype('datetime64[D]') - dates.astype('datetime64[M]')).astype(int) + 1
+
+def getWeekdays(dates):
+    #0 is monday, 1970-01-01 was a thursday
+    return (dates.astype('datetime64[D]').astype(np.int64) + 3) % 7
 
 def getWeekdayString(day):
     #print(day)
@@ -80,16 +168,48 @@ def getWeekdayString(day):
     if day == 6:
         return "Sunday"
 
+#utc offsets are looked up on this grid, all timezone transitions are at full quarter hours
+OFFSET_RESOLUTION = np.timedelta64(15, 'm')
+
+@functools.lru_cache(maxsize = 1024)
+def getOffsetTransitions(tzName, fromDay, toDay):
+    #utc times (datetime64[s]) at which the utc offset changes between the utc days fromDay
+    #and toDay and the offsets (timedelta64[s]) from then on, the first entry is fromDay
+    try:
+        tz = pytz.timezone(tzName) if tzName else pytz.utc
+    except pytz.UnknownTimeZoneError:
+        tz = pytz.utc
+    samples = np.arange(np.datetime64(fromDay, 's'), np.datetime64(toDay, 's') + np.timedelta64(1, 'D'), OFFSET_RESOLUTION)
+    offsets = np.array([pytz.utc.localize(sample).astimezone(tz).utcoffset() for sample in samples.astype(datetime)], dtype = 'timedelta64[s]')
+    changes = np.r_[True, offsets[1:] != offsets[:-1]]
+    return samples[changes], offsets[changes]
+
+def getUtcOffsets(tzName, times):
+    #utc offsets (timedelta64[s]) in tzName at the utc times (datetime64)
+    times = np.asarray(times, dtype = 'datetime64[s]')
+    transitions, offsets = getOffsetTransitions(tzName, times.min().astype('datetime64[D]').item(), times.max().astype('datetime64[D]').item())
+    return offsets[np.searchsorted(transitions, times, side = 'right') - 1]
+
+def getTimeAxis(startDate, steps):
+    #utc times (datetime64[s]) of startDate (utc) plus steps hours
+    return np.datetime64(startDate, 's') + (np.asarray(steps, dtype = float) * 3600).astype('timedelta64[s]')
+
+def getLocalDates(startDate, steps, tzName):
+    #local wall clock times (datetime64[s]) of startDate (utc) plus steps hours
+    times = getTimeAxis(startDate, steps)
+    return times + getUtcOffsets(tzName, times)
+
+def getLocalExtrema(values):
+    localMinima = np.r_[True, values[1:] < values[:-1]] & np.r_[values[:-1] < values[1:], True]
+    localMaxima = np.r_[True, values[1:] > values[:-1]] & np.r_[values[:-1] > values[1:], True]
+    return localMinima, localMaxima
+
 def plotTemperature(ax, qdata, fromIdx, toIdx, tzName, plotType):
+    from matplotlib.patches import Rectangle
+    prop = getFontProperties()
     startDate = datetime(int(qdata['date'][0:4]),int(qdata['date'][4:6]),int(qdata['date'][6:8]),int(qdata['time'][0:2]))
-    startDate = pytz.timezone('UTC').localize(startDate)
-    print("what date?", startDate)
-    if tzName:
-        try:
-            startDate = startDate.astimezone(pytz.timezone(tzName))
-        except:
-            pass
-    dates = [startDate + timedelta(hours=int(i)) for i in qdata['2t']['steps']]
+    log.debug("temperature startDate=%s", startDate)
+    dates = getLocalDates(startDate, qdata['2t']['steps'], tzName)
     #convert temperatures to numpy arrays:
     temps = {}
     temps['min'] = np.array(qdata['2t']['min'])# - 273.15
@@ -117,9 +237,8 @@ def plotTemperature(ax, qdata, fromIdx, toIdx, tzName, plotType):
     yscale = ymax-ymin
     #if the yscale is too small, small temperature changes would seem to be large.
     if yscale < 4:
-        print(yscale)
         tmp = (4 - yscale) / 4
-        print(tmp)
+        log.debug("temperature yscale=%s widened by %s", yscale, tmp)
         ymin -= tmp
         ymax += tmp
         yscale = 4
@@ -128,32 +247,26 @@ def plotTemperature(ax, qdata, fromIdx, toIdx, tzName, plotType):
     yscale = yscale / 7
     ax.vlines(dottedHours, ymin, ymax, linestyle = ':', color = "gray", zorder = 0.1)
     numberedHours = getNumberedHours(dates[fromIdx], dates[toIdx-1])
-    #print(numberedHours)
+    hours = getHours(numberedHours)
     #ax.yaxis.set_major_formatter(FormatStrFormatter('%d'+'\N{DEGREE SIGN}'+'C'))
-    coloredDay = 1
-    for hour in numberedHours:
-        if hour.hour == 0:
-            if (coloredDay%2) == 1:
-                print(hour)
-                print(hour.hour)
-                if hour != numberedHours[-2] and hour != numberedHours[-1]:
-                    ax.add_patch(Rectangle((hour,ymin),timedelta(hours=24),ymax-ymin, facecolor="#cccccccc", zorder = 0))
-                else:#in case the end of the plot is at the end of this day
-                    tdTmp = dates[toIdx-1]-hour
-                    ax.add_patch(Rectangle((hour,ymin),tdTmp,ymax-ymin, facecolor="#cccccccc", zorder = 0))
-            coloredDay += 1
-        ax.text(hour, ymax, str(hour.hour), horizontalalignment = "center", verticalalignment = "bottom", fontproperties=prop, zorder = 0)
-        if hour.hour == 12:
-            ax.text(hour, ymin-yscale/2, str(hour.day) + " " + getWeekdayString(hour.weekday()), horizontalalignment = "center", verticalalignment = "top", fontproperties=prop, zorder = 0)
+    #every other day is shaded, starting with the first midnight
+    shadedDays = np.flatnonzero(hours == 0)[::2]
+    #in case the end of the plot is at the end of a shaded day
+    widths = np.where(shadedDays < len(numberedHours) - 2, np.timedelta64(24, 'h'), dates[toIdx-1] - numberedHours[shadedDays])
+    for day, width in zip(numberedHours[shadedDays].tolist(), widths.tolist()):
+        ax.add_patch(Rectangle((day,ymin),width,ymax-ymin, facecolor="#cccccccc", zorder = 0))
+    for hour, label in zip(numberedHours.tolist(), hours.astype(str)):
+        ax.text(hour, ymax, label, horizontalalignment = "center", verticalalignment = "bottom", fontproperties=prop, zorder = 0)
+    noons = numberedHours[hours == 12]
+    for noon, day, weekday in zip(noons.tolist(), getDays(noons), getWeekdays(noons)):
+        ax.text(noon, ymin-yscale/2, str(day) + " " + getWeekdayString(weekday), horizontalalignment = "center", verticalalignment = "top", fontproperties=prop, zorder = 0)
     ax.axis('off')
     #ax.box(on=None)
     #ax.get_xaxis().set_visible(False)
     if plotType == "ensemble":
-        localMinima = np.r_[True, temps['median'][1:] < temps['median'][:-1]] & np.r_[temps['median'][:-1] < temps['median'][1:], True]
-        localMaxima = np.r_[True, temps['median'][1:] > temps['median'][:-1]] & np.r_[temps['median'][:-1] > temps['median'][1:], True]
+        localMinima, localMaxima = getLocalExtrema(temps['median'])
     elif plotType == "enhanced-hres":
-        localMinima = np.r_[True, temps['hres'][1:] < temps['hres'][:-1]] & np.r_[temps['hres'][:-1] < temps['hres'][1:], True]
-        localMaxima = np.r_[True, temps['hres'][1:] > temps['hres'][:-1]] & np.r_[temps['hres'][:-1] > temps['hres'][1:], True]
+        localMinima, localMaxima = getLocalExtrema(temps['hres'])
         yscale /= 1.6
     #print(localMaxima)
     for i in range(fromIdx,toIdx):
@@ -182,52 +295,88 @@ def plotTemperature(ax, qdata, fromIdx, toIdx, tzName, plotType):
                     verticalalignment = "center",
                     color = "white", fontproperties=prop)
 
-def plotWindBft(ax, qdata, fromIdx, toIdx, plotType):
-    #vsupFilenames = ["rain_fuzzy.png", "rain_fuzzynotraining.png", "rain_fuzzyraining.png", "rain_norain.png", "rain_lightrain.png", "rain_rain.png", "rain_strongrain.png"]
+def getSymbolPictograms(symbol, plotType):
+    #directory and filenames of the pictograms of a symbol row
+    if plotType != "enhanced-hres":
+        plotType = "ensemble"
+    return SYMBOL_PICTOGRAMS[(symbol, plotType)]
+
+def getSymbolIndices(symbol, qdata, fromIdx, toIdx, plotType):
+    #classification of every step into the pictograms of getSymbolPictograms
     if plotType == "enhanced-hres":
-        #vsupFilenames = ["", "Stufe2_Windstille.png", "Stufe3_Windstille.png", "Stufe1_leichterWind.png", "Stufe2_leichterWind.png", "Stufe3_leichterWind.png", "Stufe1_starkerWind.png", "Stufe2_starkerWind.png", "Stufe3_starkerWind.png", "Stufe1_Sturm.png", "Stufe2_Sturm.png", "Stufe3_Sturm.png"]
-        vsupFilenames = ["Stufe1_Windstille.png", "Stufe2_Windstille.png", "Stufe3_Windstille.png", "Stufe4_Windstille.png", "Stufe1_leichterWind.png", "Stufe2_leichterWind.png", "Stufe3_leichterWind.png", "Stufe4_leichterWind.png", "Stufe1_starkerWind.png", "Stufe2_starkerWind.png", "Stufe3_starkerWind.png", "Stufe4_starkerWind.png", "Stufe1_Sturm.png", "Stufe2_Sturm.png", "Stufe3_Sturm.png", "Stufe4_Sturm.png"]
-        files = [vsupFilenames[getHresWindCoordinate({key: qdata[key][i] for key in qdata})] for i in range(fromIdx,toIdx)]
-        image_path = './pictogram/wind/enhanced_hres/'
+        classify = {"cloud": getHresCloudCoordinates, "rain": getHresrainCoordinates, "wind": getHresWindCoordinates}
     else:
-        vsupFilenames = ["step1_v2.png", "Stufe2_kaumWind.png", "Stufe2_vielWind.png", "Stufe3_Windstille.png", "Stufe3_leichterWind.png", "Stufe3_starkerWind.png", "Stufe3_Sturm.png"]
-        files = [vsupFilenames[getVSUPWindCoordinate({key: qdata[key][i] for key in qdata})] for i in range(fromIdx,toIdx)]
-        image_path = './pictogram/wind/'
-    zoomFactor = 7.72 / (toIdx - fromIdx)
-    if zoomFactor > 0.45:
-        zoomFactor = 0.45
-    for (idx, filename) in zip(range(0,len(files)),files):
-        imscatter(idx,1, image_path+filename, ax=ax, zoom = zoomFactor)
+        classify = {"cloud": getVSUPCloudCoordinates, "rain": getVSUPrainCoordinates, "wind": getVSUPWindCoordinates}
+    return classify[symbol](qdata, fromIdx, toIdx)
+
+def plotSymbolRow(ax, symbol, qdata, fromIdx, toIdx, plotType):
+    directory, filenames = getSymbolPictograms(symbol, plotType)
+    files = [filenames[i] for i in getSymbolIndices(symbol, qdata, fromIdx, toIdx, plotType)]
+    zoomFactor = getPictogramZoom(toIdx - fromIdx)
+    plotPictogramStrip(ax, [getPictogram(PICTOGRAM_PATH + directory + filename, zoomFactor) for filename in files])
     ax.axis('off')
 
+def plotWindBft(ax, qdata, fromIdx, toIdx, plotType):
+    plotSymbolRow(ax, "wind", qdata, fromIdx, toIdx, plotType)
+
 def plotCloudVSUP(ax, qdata, fromIdx, toIdx, plotType):
-    #vsupFilenames = ["rain_fuzzy.png", "rain_fuzzynotraining.png", "rain_fuzzyraining.png", "rain_norain.png", "rain_lightrain.png", "rain_rain.png", "rain_strongrain.png"]
-    if plotType == "enhanced-hres":
-        #vsupFilenames = ["Stufe1_klarerHimmel.png", "Stufe2_klarerHimmel.png", "Stufe3_klarerHimmel.png", "Stufe1_leichtBedeckt.png", "Stufe2_leichtBedeckt.png", "Stufe3_leichtBedeckt.png", "Stufe1_mittlereBewoelkung.png", "Stufe2_mittlereBewoelkung.png", "Stufe3_mittlereBewoelkung.png", "Stufe1_starkBewoelkt.png", "Stufe2_starkBewoelkt.png", "Stufe3_starkBewoelkt.png"]
-        vsupFilenames = ["Stufe1_klarerHimmel.png", "Stufe2_klarerHimmel.png", "Stufe3_klarerHimmel.png", "Stufe4_klarerHimmel.png", "Stufe1_leichtBedeckt.png", "Stufe2_leichtBedeckt.png", "Stufe3_leichtBedeckt.png", "Stufe4_leichtBedeckt.png", "Stufe1_mittlereBewoelkung.png", "Stufe2_mittlereBewoelkung.png", "Stufe3_mittlereBewoelkung.png", "Stufe4_mittlereBewoelkung.png", "Stufe1_starkBewoelkt.png", "Stufe2_starkBewoelkt.png", "Stufe3_starkBewoelkt.png", "Stufe4_starkBewoelkt.png"]
-        files = [vsupFilenames[getHresCloudCoordinate({key: qdata[key][i] for key in qdata})] for i in range(fromIdx,toIdx)]
-        image_path = './pictogram/cloud/enhanced_hres/'
-    else:
-        vsupFilenames = ["step1.png", "step2_mostly_clear.png", "step2_mostly_cloudy.png", "step3_sunny.png", "step3_light_clouds.png", "step3_medium_cloudy.png", "step3_cloud_max.png"]
-        files = [vsupFilenames[getVSUPCloudCoordinate({key: qdata[key][i] for key in qdata})] for i in range(fromIdx,toIdx)]
-        image_path = './pictogram/cloud/'
-    zoomFactor = 7.72 / (toIdx - fromIdx)
-    if zoomFactor > 0.45:
-        zoomFactor = 0.45
-    for (idx, filename) in zip(range(0,len(files)),files):
-        imscatter(idx,1, image_path+filename, ax=ax, zoom = zoomFactor)
-    ax.axis('off')
+    plotSymbolRow(ax, "cloud", qdata, fromIdx, toIdx, plotType)
 
+def compositePictograms(images, centers):
+    #one uint8 RGBA strip with every image centered at its column (pixels), later images are
+    #drawn on top of earlier ones where they overlap. The images are already scaled to their
+    #size at RENDER_DPI, so they are copied pixel by pixel and only overlaps are blended.
+    left = min(center - image.shape[1] / 2 for image, center in zip(images, centers))
+    right = max(center + image.shape[1] / 2 for image, center in zip(images, centers))
+    height = max(image.shape[0] for image in images)
+    strip = np.zeros((height, int(np.ceil(right - left)) + 1, 4), dtype=np.uint8)
+    for image, center in zip(images, centers):
+        h, w = image.shape[:2]
+        x = int(round(center - w / 2 - left))
+        y = (height - h) // 2
+        dst = strip[y:y + h, x:x + w]
+        if not dst[..., 3].any():
+            dst[...] = image
+            continue
+        src = image.astype(np.float32) / 255
+        below = dst.astype(np.float32) / 255
+        srcAlpha = src[..., 3:]
+        belowAlpha = below[..., 3:] * (1 - srcAlpha)
+        alpha = srcAlpha + belowAlpha
+        color = np.divide(src[..., :3] * srcAlpha + below[..., :3] * belowAlpha, alpha,
+                          out=np.zeros_like(src[..., :3]), where=alpha > 0)
+        dst[...] = np.round(np.concatenate([color, alpha], axis=2) * 255)
+    return strip, left
+
+def plotPictogramStrip(ax, images):
+    #draws the pictograms centered at x = 0..n-1 like one imscatter call per pictogram
+    #with the axis autoscaled to them, but as a single image
+    from matplotlib.offsetbox import OffsetImage, AnnotationBbox
+    n = len(images)
+    if n == 0:
+        ax.axis('off')
+        return
+    #the x limits autoscale would choose for 0..n-1 (5% margins)
+    margin = 0.05 * (n - 1) if n > 1 else 0.05
+    xmin, xmax = -margin, n - 1 + margin
+    fig = ax.figure
+    width = ax.get_position().width * fig.get_figwidth() * RENDER_DPI#axes width in pixels at RENDER_DPI
+    centers = [(i - xmin) / (xmax - xmin) * width for i in range(n)]
+    strip, left = compositePictograms(images, centers)
+    #one strip pixel per output pixel, the meteograms are saved at RENDER_DPI: nothing is resampled
+    #(zoom = 72 / RENDER_DPI is not exact in floating point and makes agg resample the strip)
+    ax.add_artist(AnnotationBbox(OffsetImage(strip, dpi_cor=False), ((left + strip.shape[1] / 2) / width, 0.5),
+                                 xycoords='axes fraction', frameon=False, pad=0))
+    ax.axis('off')
 
 def imscatter(x, y, image, ax=None, zoom=1):
     #taken from https://stackoverflow.com/questions/22566284/matplotlib-how-to-plot-images-instead-of-points
+    from matplotlib.offsetbox import OffsetImage, AnnotationBbox
     if ax is None:
-        ax = plt.gca()
-    try:
-        image = plt.imread(image)
-    except TypeError:
-        # Likely already an array...
-        pass
+        ax = getPyplot().gca()
+    if isinstance(image, str):
+        image = getPyplot().imread(image)
+    #otherwise likely already an array...
     im = OffsetImage(image, zoom=zoom)
     x, y = np.atleast_1d(x, y)
     artists = []
@@ -402,79 +551,134 @@ def getVSUPrainCoordinate(qdata):
         return(1)#possibly light rain
     return(0)
 
-def plotPrecipitationVSUP(ax, qdata, fromIdx, toIdx, plotType):
-    if plotType == "enhanced-hres":
-        #hresFilenames = ["Stufe1_KeinRegen.png", "Stufe2_KeinRegen.png", "Stufe3_KeinRegen.png", "Stufe1_leichterRegen.png", "Stufe2_leichterRegen.png", "Stufe3_leichterRegen.png", "Stufe1_MittlererRegen.png", "Stufe2_MittlererRegen.png", "Stufe3_MittlererRegen.png", "Stufe1_Starkregen.png", "Stufe2_Starkregen.png",  "Stufe3_Starkregen.png"]
-        hresFilenames = ["Stufe1_KeinRegen.png", "Stufe2_KeinRegen.png", "Stufe3_KeinRegen.png", "Stufe4_KeinRegen.png", "Stufe1_leichterRegen.png", "Stufe2_leichterRegen.png", "Stufe3_leichterRegen.png", "Stufe4_leichterRegen.png", "Stufe1_MittlererRegen.png", "Stufe2_MittlererRegen.png", "Stufe3_MittlererRegen.png", "Stufe4_MittlererRegen.png", "Stufe1_Starkregen.png", "Stufe2_Starkregen.png", "Stufe3_Starkregen.png", "Stufe4_Starkregen.png"]
-        files = [hresFilenames[getHresrainCoordinate({key: qdata[key][i] for key in qdata})] for i in range(fromIdx,toIdx)]
-        image_path = './pictogram/rain/enhanced_hres/'
-    else:
-        vsupFilenames = ["step1_v2.png", "Stufe2_KaumRegen.png", "Stufe2_Regen.png", "Stufe3_KeinRegen.png", "Stufe3_leichterRegen.png", "Stufe3_MittlererRegen.png", "Stufe3_Starkregen.png"]
-        files = [vsupFilenames[getVSUPrainCoordinate({key: qdata[key][i] for key in qdata})] for i in range(fromIdx,toIdx)]
-        image_path = './pictogram/rain/'
-    zoomFactor = 7.72 / (toIdx - fromIdx)
-    if zoomFactor > 0.45:
-        zoomFactor = 0.45
-    print(zoomFactor)
-    for (idx, filename) in zip(range(0,len(files)),files):
-        imscatter(idx,1, image_path+filename, ax=ax, zoom = zoomFactor)
-    ax.axis('off')
+def getQuantileArrays(qdata, keys, fromIdx = 0, toIdx = None):
+    #slice the percentile lists of one variable into numpy arrays for the window
+    return {key: np.asarray(qdata[key][fromIdx:toIdx], dtype=float) for key in keys}
 
+def getHresCoordinates(qdata, noThreshold, lightThreshold, strongThreshold, fromIdx = 0, toIdx = None):
+    #vectorized version of the getHres*Coordinate functions, they all share the same scheme:
+    #hres < noThreshold: 0-3, hres < lightThreshold: 4-7, hres > strongThreshold: 12-15, else 8-11
+    q = getQuantileArrays(qdata, ['hres', 'ten', 'twenty_five', 'median', 'ninety'], fromIdx, toIdx)
+    hres = q['hres']
+    no = np.select([q['ninety'] < noThreshold, q['median'] < noThreshold, q['twenty_five'] < noThreshold], [3, 2, 1], 0)
+    light = np.select([q['ninety'] < lightThreshold, q['median'] < lightThreshold, q['twenty_five'] < lightThreshold], [7, 6, 5], 4)
+    strong = np.select([q['ten'] > strongThreshold, q['median'] > strongThreshold, q['twenty_five'] > strongThreshold], [15, 14, 13], 12)
+    medium = np.select([q['ten'] > lightThreshold, q['median'] > lightThreshold, q['twenty_five'] > lightThreshold], [11, 10, 9], 8)
+    return np.select([hres < noThreshold, hres < lightThreshold, hres > strongThreshold], [no, light, strong], medium).astype(int)
 
-def getTimeFrame(allMeteogramData,fromDate, toDate):
-    #print(allMeteogramData)
+def getHresCloudCoordinates(qdata, fromIdx = 0, toIdx = None):
+    return getHresCoordinates(qdata, 0.1, 0.5, 0.9, fromIdx, toIdx)
+
+def getHresWindCoordinates(qdata, fromIdx = 0, toIdx = None):
+    return getHresCoordinates(qdata, 3, 10, 17.2, fromIdx, toIdx)
+
+def getHresrainCoordinates(qdata, fromIdx = 0, toIdx = None):
+    return getHresCoordinates(qdata, 1e-4, 1e-3, 2e-3, fromIdx, toIdx)
+
+def getVSUPCloudCoordinates(qdata, fromIdx = 0, toIdx = None):
+    q = getQuantileArrays(qdata, ['ten', 'twenty_five', 'seventy_five', 'ninety'], fromIdx, toIdx)
+    return np.select([q['ninety'] < 0.1,#no cloud
+                      q['ten'] > 0.9,#all cloudy
+                      q['ten'] > 0.5,#lot of clouds
+                      q['ninety'] < 0.5,#light clouds
+                      q['seventy_five'] < 0.7,#possibly light clouds
+                      q['twenty_five'] > 0.3],#possibly strong clouds
+                     [3, 6, 5, 4, 1, 2], 0).astype(int)
+
+def getVSUPWindCoordinates(qdata, fromIdx = 0, toIdx = None):
+    q = getQuantileArrays(qdata, ['ten', 'twenty_five', 'seventy_five', 'ninety'], fromIdx, toIdx)
+    return np.select([q['ninety'] < 3,#no wind
+                      q['ten'] > 17.2,#storm
+                      (q['ten'] > 10) & (q['ninety'] < 17.2),#strong wind
+                      q['ninety'] < 10,#light wind
+                      q['twenty_five'] > 10,#probably strong wind
+                      q['seventy_five'] < 10],#probably light wind
+                     [3, 6, 5, 4, 2, 1], 0).astype(int)
+
+def getVSUPrainCoordinates(qdata, fromIdx = 0, toIdx = None):
+    q = getQuantileArrays(qdata, ['ten', 'median', 'seventy_five', 'ninety'], fromIdx, toIdx)
+    return np.select([q['ninety'] < 1e-4,#no rain
+                      q['ten'] > 2e-3,#strong rain
+                      (q['ten'] > 1e-3) & (q['ninety'] < 2e-3),#medium rain
+                      q['ten'] > 1e-3,#possibly rain
+                      q['ninety'] < 1e-3,#light rain
+                      q['median'] > 1e-3,#possibly strong or medium rain
+                      q['seventy_five'] < 1.5e-3],#possibly light rain
+                     [3, 6, 5, 2, 4, 2, 1], 0).astype(int)
+
+def plotPrecipitationVSUP(ax, qdata, fromIdx, toIdx, plotType):
+    plotSymbolRow(ax, "rain", qdata, fromIdx, toIdx, plotType)
+
+def getMeteogramTimeAxis(allMeteogramData):
+    #utc times (datetime64[s]) of the steps of a meteogram, daily meteograms have one step per day
     if '2t' in allMeteogramData:
         qdata = allMeteogramData['2t']
-        startDate = datetime(int(qdata['date'][0:4]),int(qdata['date'][4:6]),int(qdata['date'][6:8]), int(qdata['time'][0:2]))
-        dates = [startDate + timedelta(hours=int(i)) for i in qdata['2t']['steps']]
-        fromIndex = 0
-        if fromDate:
-            for date in dates:
-                if date < fromDate:
-                    fromIndex += 1
-                else:
-                    break
-        toIndex = len(allMeteogramData['2t']['2t']['steps'])
-        print(toIndex)
-        if toDate:
-            for date in dates[::-1]:
-                if date < toDate:
-                    break
-                else:
-                    toIndex -= 1
-    elif 'tp24' in allMeteogramData:
+        steps = qdata['2t']['steps']
+    else:
         qdata = allMeteogramData['tp24']
-        startDate = datetime(int(qdata['date'][0:4]),int(qdata['date'][4:6]),int(qdata['date'][6:8]), int(qdata['time'][0:2]))
-        dates = [startDate + timedelta(int(i)) for i in range(1,16)]
-        fromIndex = 0
-        if fromDate:
-            for date in dates:
-                if date < fromDate:
-                    fromIndex += 1
-                else:
-                    break
-        toIndex = 15
-        if toDate:
-            for date in dates[::-1]:
-                if date < toDate:
-                    break
-                else:
-                    toIndex -= 1
-    #print(toIndex)
-    #print(fromIndex)
+        steps = 24 * np.arange(1, len(qdata['tp24']['median']) + 1)
+    startDate = datetime(int(qdata['date'][0:4]),int(qdata['date'][4:6]),int(qdata['date'][6:8]), int(qdata['time'][0:2]))
+    return getTimeAxis(startDate, steps)
+
+def getTimeFrame(allMeteogramData,fromDate, toDate):
+    #indices of the first step not before fromDate and after the last step before toDate
+    dates = getMeteogramTimeAxis(allMeteogramData)
+    fromIndex = int(np.searchsorted(dates, np.datetime64(fromDate, 's'))) if fromDate else 0
+    toIndex = int(np.searchsorted(dates, np.datetime64(toDate, 's'))) if toDate else len(dates)
     return (fromIndex, toIndex)
 
-def plotMeteogram(allMeteogramData, fromIndex, toIndex, tzName, plotType):
-    print(plotType)
-    fig = plt.figure(figsize=(14,6))
+#figures with their axes per layout that no render uses right now, see checkoutFigure
+_figureSkeletons = {}#layout -> list of (fig, axes)
+_figureSkeletonsLock = threading.Lock()
+#idle figures kept per layout, about the number of threads rendering at once
+MAX_FIGURE_SKELETONS = 4
+
+def createFigure(pyplot = True):
+    #without pyplot the figure is not registered globally and goes away with its last reference
+    from matplotlib import gridspec
+    from matplotlib.figure import Figure
+    fig = getPyplot().figure(figsize=(14,6)) if pyplot else Figure(figsize=(14,6))
     gs = gridspec.GridSpec(4, 1, height_ratios=[1, 1, 4, 1])
     ax1 = fig.add_subplot(gs[0])
     ax2 = fig.add_subplot(gs[1])
     ax3 = fig.add_subplot(gs[2])
     ax4 = fig.add_subplot(gs[3])
+    return fig, (ax1, ax2, ax3, ax4)
+
+def checkoutFigure(layout):
+    #a figure and its axes for the layout, built once per process and emptied for every
+    #render, so only the data dependent artists are created per meteogram. The render
+    #owns it until it hands it back with checkinFigure.
+    with _figureSkeletonsLock:
+        skeletons = _figureSkeletons.get(layout)
+        skeleton = skeletons.pop() if skeletons else None
+    if skeleton is None:
+        return createFigure(pyplot = False)
+    fig, axes = skeleton
+    for ax in axes:
+        ax.cla()
+    #fig.text artists of the last render, the suptitle is reused by fig.suptitle
+    for text in list(fig.texts):
+        if text is not getattr(fig, "_suptitle", None):
+            text.remove()
+    return fig, axes
+
+def checkinFigure(layout, fig):
+    #fig of checkoutFigure(layout) can be reused by the next render of the layout
+    with _figureSkeletonsLock:
+        skeletons = _figureSkeletons.setdefault(layout, [])
+        if len(skeletons) < MAX_FIGURE_SKELETONS:
+            skeletons.append((fig, tuple(fig.axes[:4])))
+
+def plotMeteogram(allMeteogramData, fromIndex, toIndex, tzName, plotType, layout = None):
+    #with a layout, e.g. (days, plotType), the figure comes from checkoutFigure, it must
+    #not be closed and should be handed back with checkinFigure when it is saved
+    log.debug("plotMeteogram plotType=%s fromIndex=%s toIndex=%s", plotType, fromIndex, toIndex)
+    if layout is None:
+        fig, (ax1, ax2, ax3, ax4) = createFigure()
+    else:
+        fig, (ax1, ax2, ax3, ax4) = checkoutFigure(layout)
     if 'tp' in allMeteogramData:#10days 6hourly meteogram
-        print("plot my meteogram")
-        print(fromIndex, toIndex)
         fromIndex = 1
         plotCloudVSUP(ax1, allMeteogramData['tcc']['tcc'], fromIndex, toIndex, plotType)
         plotPrecipitationVSUP(ax2, allMeteogramData['tp']['tp'], fromIndex, toIndex, plotType)
@@ -486,38 +690,115 @@ def plotMeteogram(allMeteogramData, fromIndex, toIndex, tzName, plotType):
         dictNew = {'time':allMeteogramData['mn2t24']['time'],
            'date': allMeteogramData['mn2t24']['date'],
            '2t': {}}
-        for key in ['max','median','min','ninety','seventy_five','ten','twenty_five']:
+        for key in ['max','median','min','ninety','seventy_five','ten','twenty_five','hres']:
+            if key not in allMeteogramData['mn2t24']['mn2t24']:
+                continue
             tmpList = []
             for mn, mx in zip(allMeteogramData['mn2t24']['mn2t24'][key],allMeteogramData['mx2t24']['mx2t24'][key]):
                 tmpList.append(mn)
                 tmpList.append(mx)
             dictNew['2t'][key] = tmpList
         startDate = datetime(int(dictNew['date'][0:4]),int(dictNew['date'][4:6]),int(dictNew['date'][6:8]))
-        startDate = pytz.timezone('UTC').localize(startDate)
-        if tzName:
-            try:
-                startDate = startDate.astimezone(pytz.timezone(tzName))
-            except:
-                pass
-        steps = [28 - startDate.utcoffset().total_seconds()/3600]
-        print(steps)
+        utcOffset = getUtcOffsets(tzName, [startDate])[0] / np.timedelta64(1, 'h')
+        #the minimum of a day at 4 and the maximum at 16 o'clock local time
+        steps = [4 - utcOffset]
+        log.debug("daily temperature steps=%s", steps)
         for _ in range(1,len(dictNew['2t']['max'])):
             steps.append(steps[-1]+12)
         dictNew['2t']['steps'] = steps
-        allMeteogramData['2t'] = dictNew
-        plotTemperature(ax3, allMeteogramData['2t'], fromIndex, toIndex + (toIndex+fromIndex), tzName, plotType)
+        plotTemperature(ax3, dictNew, fromIndex, toIndex + (toIndex+fromIndex), tzName, plotType)
         plotWindBft(ax4, allMeteogramData['ws24']['ws24'], fromIndex, toIndex, plotType)
     return fig
 
 
+#percentile series a meteogram is drawn from
+SERIES_KEYS = ['min', 'ten', 'twenty_five', 'median', 'seventy_five', 'ninety', 'max', 'hres']
+
+def getMeteogramSeries(allMeteogramData, days, tzName, plotType, today = None):
+    #everything plotMeteogram draws, as arrays for the same time window, so clients can
+    #render the meteogram themselves: utc times, utc offsets, percentile series,
+    #temperature extrema and the pictogram indices of the symbol rows
+    if today is None:
+        today = datetime.utcnow()
+    fromIndex, toIndex = getTimeFrame(allMeteogramData, today, today + timedelta(days))
+    if 'tp' in allMeteogramData:#10days 6hourly meteogram
+        fromIndex = 1
+        names = {"cloud": "tcc", "rain": "tp", "wind": "ws"}
+        temperatures = ["2t"]
+    else:#15days daily meteogram
+        names = {"cloud": "tcc24", "rain": "tp24", "wind": "ws24"}
+        temperatures = ["mn2t24", "mx2t24"]
+    times = getMeteogramTimeAxis(allMeteogramData)[fromIndex:toIndex]
+    utcOffsets = getUtcOffsets(tzName, times).astype(np.int64)
+    times = times.astype(np.int64)
+    series = {}
+    for name in list(names.values()) + temperatures:
+        data = allMeteogramData[name][name]
+        series[name] = {key: np.asarray(data[key][fromIndex:toIndex], dtype = np.float32) for key in SERIES_KEYS if key in data}
+    if len(temperatures) == 1:
+        line = allMeteogramData['2t']['2t']['hres' if plotType == "enhanced-hres" else 'median']
+        localMinima, localMaxima = getLocalExtrema(np.asarray(line, dtype = float))
+        extrema = {"min": np.flatnonzero(localMinima[fromIndex:toIndex]), "max": np.flatnonzero(localMaxima[fromIndex:toIndex])}
+    else:
+        #the daily minimum and maximum are the extrema
+        extrema = {"min": np.arange(toIndex - fromIndex), "max": np.arange(toIndex - fromIndex)}
+    symbols = {}
+    for symbol, name in names.items():
+        directory, filenames = getSymbolPictograms(symbol, plotType)
+        symbols[symbol] = {"index": getSymbolIndices(symbol, allMeteogramData[name][name], fromIndex, toIndex, plotType),
+                           "pictograms": [directory + filename for filename in filenames]}
+    return {"time": times, "utcOffset": utcOffsets, "series": series, "extrema": extrema, "symbols": symbols}
+
+def renderMeteogramPng(allMeteogramData, days, tzName, plotType, title, today = None):
+    #the whole meteogram as png bytes, used by the web app and its render workers
+    if today is None:
+        today = datetime.utcnow()
+    fromIndex, toIndex = getTimeFrame(allMeteogramData, today, today + timedelta(days))
+    fromIndex = 0
+    layout = (days, plotType)
+    with metrics.stage("draw"):
+        fig = plotMeteogram(allMeteogramData, fromIndex, toIndex, tzName, plotType, layout = layout)
+    #a copy, the font properties are shared by all renders
+    prop = getFontProperties()
+    titleProp = prop.copy()
+    titleProp.set_size(16)
+    fig.suptitle(title, fontproperties=titleProp)
+    if '2t' in allMeteogramData:
+        #fig.text(0.1,0.03,allMeteogramData['2t']['date']+"-"+allMeteogramData['2t']['time'],fontproperties=prop)
+        fig.text(0.2,0.06,"Forecast from the European Weather Centre from " + allMeteogramData['2t']['date']+" at "+allMeteogramData['2t']['time'][0:2] + ":" + allMeteogramData['2t']['time'][0:2] + " UTC",fontproperties=prop)
+    if 'tp24' in allMeteogramData:
+        fig.text(0.2,0.06,"Forecast from the European Weather Centre from " + allMeteogramData['tp24']['date']+" at "+allMeteogramData['tp24']['time'][0:2] + ":" + allMeteogramData['tp24']['time'][0:2] + " UTC",fontproperties=prop)
+        #fig.text(0.1,0.03,allMeteogramData['tp24']['date']+"-"+allMeteogramData['tp24']['time'],fontproperties=prop)
+    buffer = BytesIO()
+    with metrics.stage("encode"):
+        fig.savefig(buffer, format = "png", dpi=RENDER_DPI, bbox_inches = 'tight')
+    #only a figure that rendered completely is reused
+    checkinFigure(layout, fig)
+    return buffer.getvalue()
+
+
+def preload():
+    #imports matplotlib and loads the font and the pictograms, e.g. once in a parent
+    #process that forks workers afterwards
+    from matplotlib import gridspec
+    from matplotlib.figure import Figure
+    from matplotlib.patches import Rectangle
+    import matplotlib.backends.backend_agg
+    getFontProperties()
+    warmPictogramCache()
+
+
 if __name__ == '__main__':
+    prop = getFontProperties()
+    if not os.path.exists("output/"):
+        os.mkdir("output")
     #today = datetime.date.today()
     today = datetime.utcnow()
     days = 15
     plotType = "ensemble"
     if len(sys.argv) > 1:
         print(sys.argv)
-        from downloadJsonData import getData, getCoordinates
+        from downloadJsonData import getData, getCoordinates, getTimezone
         try:
             opts, args = getopt.getopt(sys.argv[1:], "hd:", ["days=", "lat=", "lon=", "location=", "ensemble", "hres"])
         except getopt.GetoptError:
@@ -543,9 +824,10 @@ if __name__ == '__main__':
             elif opt == "--hres":
                 plotType = "enhanced-hres"
         if days <= 10:
-            allMeteogramData = getData(float(longitude), float(latitude), altitude, writeToFile = False)
+            allMeteogramData = getData(float(longitude), float(latitude), altitude, writeToFile = False, days = days)
         else:
-            allMeteogramData = getData(float(longitude), float(latitude), altitude, writeToFile = False, meteogram = "15days")
+            allMeteogramData = getData(float(longitude), float(latitude), altitude, writeToFile = False, meteogram = "15days", days = days,
+                                       tzName = getTimezone(float(latitude), float(longitude)))
     else:
         print(type(today))
         print(today)
@@ -567,8 +849,8 @@ if __name__ == '__main__':
         #    allMeteogramData['ws'] = json.load(fp)
         #with open("data/tcc-10days.json", "r") as fp:
         #    allMeteogramData['tcc'] = json.load(fp)
-    tf = TimezoneFinder()
-    tzName = tf.timezone_at(lat=latitude, lng=longitude)
+    from downloadJsonData import getTimezone
+    tzName = getTimezone(latitude, longitude)
     #tzName = tz.tzNameAt(latitude, longitude)
     #tzName = "Europe/Berlin"
     fromIndex, toIndex = getTimeFrame(allMeteogramData, today, today + timedelta(days))
@@ -1,3 +1,69 @@
 #!venv/bin/python
+import sys, os, getopt, socket, signal, logging
 from app import app
-app.run(debug=True, host="0.0.0.0", port = 5003)
+
+log = logging.getLogger("run")
+
+def serveForked(host, port, workers):
+    #the parent loads everything once and forks the workers from it, they start warm and
+    #share the loaded modules, timezone polygons and pictograms copy on write.
+    #A worker that exits is replaced by a new fork instead of a cold python start.
+    #Every worker renders in a render pool of its own (timeouts, recycling and crash isolation
+    #as in the threaded server), the render processes are spawned by the worker on first use.
+    #Caches, request counts and /metrics are per worker, only one worker prewarms.
+    from werkzeug.serving import make_server
+    from app import controller
+    controller.preload()
+    listener = socket.create_server((host, port), backlog = 128)
+    children = set()
+    prewarmEnabled = app.config.get('PREWARM_ENABLED')
+    prewarmWorker = None
+
+    def forkWorker(prewarm):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            app.config['PREWARM_ENABLED'] = prewarmEnabled and prewarm
+            make_server(host, port, app, threaded = True, fd = listener.fileno()).serve_forever()
+            os._exit(0)
+        children.add(pid)
+        return pid
+
+    def stop(signum, frame):
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for i in range(workers):
+        pid = forkWorker(i == 0)
+        if i == 0:
+            prewarmWorker = pid
+    log.warning("serving on %s:%d with %d forked workers", host, port, workers)
+    while True:
+        pid, status = os.wait()
+        children.discard(pid)
+        log.warning("worker pid=%d exited status=%d, forking a new one", pid, status)
+        if pid == prewarmWorker:
+            prewarmWorker = forkWorker(True)
+        else:
+            forkWorker(False)
+
+#the render workers import this module again, they must not start a server
+if __name__ == '__main__':
+    #run.py                     flask development server with reloader
+    #run.py --prefork [-w 4]    warm parent with forked worker processes, see serveForked
+    opts, args = getopt.getopt(sys.argv[1:], "w:", ["prefork", "workers="])
+    prefork = False
+    workers = app.config.get('PREFORK_WORKERS', 4)
+    for opt, arg in opts:
+        if opt == "--prefork":
+            prefork = True
+        elif opt in ("-w", "--workers"):
+            workers = int(arg)
+    if prefork:
+        serveForked("0.0.0.0", 5003, workers)
+    else:
+        app.run(debug=True, host="0.0.0.0", port = 5003)
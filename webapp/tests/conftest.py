@@ -0,0 +1,6 @@
+import os
+import sys
+
+#the tests import the modules of the web app like its command line scripts do
+WEBAPP_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, WEBAPP_PATH)
@@ -0,0 +1,58 @@
+#the 15days meteogram aggregates local calendar days, also across a change of the utc
+#offset: Europe/Berlin goes back from +2 to +1 hours on 2026-10-25, that day has 25 hours
+import numpy as np
+import pytest
+
+import downloadJsonData as dl
+
+START = np.datetime64("2026-10-22T00:00:00")
+HOURS = 6 * 24
+
+def getEnsemble(utcOffsetSeconds = 7200, start = START, hours = HOURS):
+    #every member has 1 mm of precipitation every hour and the hour of the step as temperature
+    dates = start + np.arange(hours) * np.timedelta64(1, 'h')
+    cube = np.zeros((4, 3, hours), dtype = np.float32)
+    cube[0] = np.arange(hours)
+    cube[1] = 1
+    return {"dates": dates,
+            "cube": cube,
+            "variables": ["temperature_2m", "precipitation", "cloud_cover", "wind_speed_10m"],
+            "utcOffsetSeconds": utcOffsetSeconds}
+
+def getDaily(daily, name):
+    return daily[[variable[0] for variable in dl.DAILY_VARIABLES].index(name)]
+
+def test_dst_change():
+    daily, firstDay = dl.aggregateDaily(getEnsemble(), "Europe/Berlin")
+    #the data starts at 02:00 local time on the 22nd, which is incomplete, and ends with
+    #the first hour of the 28th
+    assert firstDay == np.datetime64("2026-10-23")
+    np.testing.assert_array_equal(getDaily(daily, "tp24")[0], [24, 24, 25, 24, 24])
+    #the days start at local midnight: 22:00 utc before and 23:00 utc after the change
+    np.testing.assert_array_equal(getDaily(daily, "mn2t24")[0], [22, 46, 70, 95, 119])
+    np.testing.assert_array_equal(getDaily(daily, "mx2t24")[0], [45, 69, 94, 118, 142])
+
+@pytest.mark.parametrize("tzName", [None, "Nowhere/Unknown"])
+def test_fixed_offset(tzName):
+    #without a known timezone every day is cut at the utc offset open-meteo reported
+    daily, firstDay = dl.aggregateDaily(getEnsemble(), tzName)
+    assert firstDay == np.datetime64("2026-10-23")
+    np.testing.assert_array_equal(getDaily(daily, "tp24")[0], [24] * 5)
+    np.testing.assert_array_equal(getDaily(daily, "mn2t24")[0], [22, 46, 70, 94, 118])
+
+def test_half_hour_offset():
+    #Asia/Kolkata is 5:30 hours ahead, the hourly steps never fall on local midnight
+    daily, firstDay = dl.aggregateDaily(getEnsemble(19800), "Asia/Kolkata")
+    assert firstDay == np.datetime64("2026-10-23")
+    np.testing.assert_array_equal(getDaily(daily, "tp24")[0], [24] * 5)
+    np.testing.assert_array_equal(getDaily(daily, "mn2t24")[0], [19, 43, 67, 91, 115])
+
+@pytest.mark.parametrize("days", [11, 13, 15])
+def test_forecast_days_cover_meteogram(days):
+    #open-meteo answers from local midnight, the forecast days downloaded for a meteogram
+    #of more than 10 days must give a complete local day for every column
+    hours = dl.getForecastDays(days) * 24
+    ensemble = dl.trimEnsemble(getEnsemble(start = START - np.timedelta64(2, 'h'), hours = hours), dl.getForecastDays(days))
+    daily, firstDay = dl.aggregateDaily(ensemble, "Europe/Berlin")
+    assert firstDay == np.datetime64("2026-10-22")
+    assert getDaily(daily, "tp24").shape[1] >= days
@@ -0,0 +1,38 @@
+#calculate_quantiles reads all percentiles from one sort of the members, it must give what
+#np.percentile gives, also for cells where a member is missing (NaN)
+import numpy as np
+
+import downloadJsonData as dl
+
+def getCube(seed = 20261018):
+    #(variable, member, time) like the downloaded ensembles, with some NaN members
+    rng = np.random.default_rng(seed)
+    cube = rng.gamma(2, 3, (4, dl.ENSEMBLE_MEMBERS, 48)).astype(np.float32)
+    cube[0, 7, 5] = np.nan
+    cube[1, :, 10] = np.nan
+    cube[3, ::2, 20:24] = np.nan
+    return cube
+
+def test_percentiles():
+    cube = getCube()
+    quantiles = dl.calculate_quantiles(cube)
+    expected = np.moveaxis(np.percentile(cube, dl.PERCENTILES, axis = 1), 0, 1)
+    assert quantiles.shape == (4, len(dl.PERCENTILES), 48)
+    np.testing.assert_allclose(quantiles, expected, rtol = 1e-6, equal_nan = True)
+    #a single NaN member makes the whole cell NaN, as with np.percentile
+    assert np.isnan(quantiles[0, :, 5]).all()
+    assert not np.isnan(quantiles[0, :, 6]).any()
+
+def test_member_time_array():
+    cube = getCube()
+    quantiles, probabilities = dl.calculate_quantiles(cube[1], thresholds = [1.0])
+    np.testing.assert_allclose(quantiles, np.percentile(cube[1], dl.PERCENTILES, axis = 0), rtol = 1e-6, equal_nan = True)
+    np.testing.assert_allclose(probabilities, (cube[1] > 1.0).mean(axis = 0))
+
+def test_probabilities():
+    cube = getCube()
+    _, probabilities = dl.calculate_quantiles(cube, thresholds = [None, 1.0, None, 17.2])
+    assert np.isnan(probabilities[[0, 2]]).all()
+    #NaN members do not exceed the threshold but count as members
+    np.testing.assert_allclose(probabilities[1], (cube[1] > 1.0).mean(axis = 0))
+    np.testing.assert_allclose(probabilities[3], (cube[3] > 17.2).mean(axis = 0))
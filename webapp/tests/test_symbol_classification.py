@@ -0,0 +1,65 @@
+#the vectorized symbol classifiers must give the same pictogram as the scalar ones
+#they replaced, for every step
+import numpy as np
+import pytest
+
+import plotMeteogram as pm
+
+KEYS = ['min', 'ten', 'twenty_five', 'median', 'seventy_five', 'ninety', 'max', 'hres']
+#thresholds the classifiers of each symbol compare against
+THRESHOLDS = {"cloud": [0.1, 0.3, 0.5, 0.7, 0.9],
+              "wind": [3, 10, 17.2],
+              "rain": [1e-4, 1e-3, 1.5e-3, 2e-3]}
+CLASSIFIERS = [
+    ("cloud", pm.getHresCloudCoordinate, pm.getHresCloudCoordinates),
+    ("cloud", pm.getVSUPCloudCoordinate, pm.getVSUPCloudCoordinates),
+    ("wind", pm.getHresWindCoordinate, pm.getHresWindCoordinates),
+    ("wind", pm.getVSUPWindCoordinate, pm.getVSUPWindCoordinates),
+    ("rain", pm.getHresrainCoordinate, pm.getHresrainCoordinates),
+    ("rain", pm.getVSUPrainCoordinate, pm.getVSUPrainCoordinates),
+]
+
+def getQdata(values):
+    #percentile lists of one variable, values has a column per key
+    return {key: values[:, i].tolist() for i, key in enumerate(KEYS)}
+
+def assertEquivalent(scalar, vectorized, qdata):
+    expected = [scalar({key: qdata[key][i] for key in KEYS}) for i in range(len(qdata['hres']))]
+    np.testing.assert_array_equal(vectorized(qdata), expected)
+
+def getCandidates(symbol):
+    #the thresholds, values right next to them and values far below and above
+    thresholds = np.asarray(THRESHOLDS[symbol], dtype = float)
+    return np.concatenate([thresholds, np.nextafter(thresholds, -np.inf), np.nextafter(thresholds, np.inf),
+                           [0, thresholds[-1] * 10]])
+
+@pytest.mark.parametrize("symbol, scalar, vectorized", CLASSIFIERS)
+def test_random(symbol, scalar, vectorized):
+    rng = np.random.default_rng(0)
+    values = rng.uniform(0, THRESHOLDS[symbol][-1] * 1.5, (2000, len(KEYS)))
+    assertEquivalent(scalar, vectorized, getQdata(values))
+
+@pytest.mark.parametrize("symbol, scalar, vectorized", CLASSIFIERS)
+def test_thresholds(symbol, scalar, vectorized):
+    #every key at and next to every threshold, the other keys at random candidates
+    rng = np.random.default_rng(1)
+    candidates = getCandidates(symbol)
+    values = rng.choice(candidates, (5000, len(KEYS)))
+    assertEquivalent(scalar, vectorized, getQdata(values))
+
+@pytest.mark.parametrize("symbol, scalar, vectorized", CLASSIFIERS)
+def test_nan(symbol, scalar, vectorized):
+    #missing members give NaN percentiles, all comparisons with them are false
+    rng = np.random.default_rng(2)
+    candidates = np.append(getCandidates(symbol), np.nan)
+    values = rng.choice(candidates, (5000, len(KEYS)))
+    values[:len(KEYS)] = np.nan
+    assertEquivalent(scalar, vectorized, getQdata(values))
+
+@pytest.mark.parametrize("symbol, scalar, vectorized", CLASSIFIERS)
+def test_window(symbol, scalar, vectorized):
+    #fromIdx and toIdx select the same steps as slicing the percentile lists
+    rng = np.random.default_rng(3)
+    qdata = getQdata(rng.choice(getCandidates(symbol), (100, len(KEYS))))
+    window = {key: qdata[key][10:60] for key in KEYS}
+    np.testing.assert_array_equal(vectorized(qdata, 10, 60), vectorized(window))